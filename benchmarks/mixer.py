@@ -0,0 +1,79 @@
+"""
+Measures the time AudioMixer needs to mix one frame of N streams
+and compares it with the previous audioop-based implementation
+Run from the repository root: python benchmarks/mixer.py [N ...]
+"""
+
+import os
+import sys
+import timeit
+from functools import reduce
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from discord import AudioSource  # noqa: E402
+from discord.opus import Encoder as OpusEncoder  # noqa: E402
+
+from musicbot.ffmpeg import AudioMixer  # noqa: E402
+
+try:
+    import audioop
+except ImportError:  # Python >= 3.13 without audioop-lts
+    audioop = None
+
+STREAM_COUNTS = (1, 2, 4, 8)
+REPEAT = 5000
+
+
+class Client:
+    "Stands in for VoiceClient, the mixer is read directly"
+
+    def is_playing(self) -> bool:
+        return True
+
+
+class Tone(AudioSource):
+    def __init__(self, frequency: float):
+        samples = OpusEncoder.FRAME_SIZE // 2
+        time = np.arange(samples // 2) / OpusEncoder.SAMPLING_RATE
+        wave = np.sin(2 * np.pi * frequency * time) * 20000
+        self.frame = np.repeat(wave, 2).astype(np.int16).tobytes()
+
+    def read(self) -> bytes:
+        return self.frame
+
+
+def measure(func) -> float:
+    "Returns average time per frame in microseconds"
+    return timeit.timeit(func, number=REPEAT) / REPEAT * 1e6
+
+
+def mix_audioop(frames, volume: float) -> bytes:
+    return reduce(
+        lambda a, b: audioop.add(a, b, 2),
+        (audioop.mul(frame, 2, volume) for frame in frames),
+        AudioMixer.SILENCE,
+    )
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or STREAM_COUNTS
+    for count in counts:
+        mixer = AudioMixer(Client())
+        sources = [Tone(220 * (i + 1)) for i in range(count)]
+        for source in sources:
+            # volume below 100% disables the Opus fast path
+            mixer.add_stream(source, volume=0.8)
+
+        line = f"{count} streams: mixer {measure(mixer.read):.1f} us/frame"
+        if audioop:
+            frames = [source.frame for source in sources]
+            audioop_time = measure(lambda: mix_audioop(frames, 0.8))
+            line += f", audioop {audioop_time:.1f} us/frame"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
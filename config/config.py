@@ -42,6 +42,13 @@ class Config:
 
     # maximum of 25
     MAX_SONG_PRELOAD = 5
+    # how many songs after the next one can be preloaded simultaneously
+    PRELOAD_CONCURRENCY = 2
+    # preloaded songs are loaded again this many seconds
+    # before their stream URLs expire, 0 to disable
+    STREAM_REFRESH_MARGIN = 600
+    # limit for such refreshes across all guilds
+    STREAM_REFRESHES_PER_MINUTE = 10
     # how many results to display in d!search
     SEARCH_RESULTS = 5
 
@@ -49,8 +56,75 @@ class Config:
     MAX_TRACKNAME_HISTORY_LENGTH = 15
 
     # increasing this will cause higher memory usage
-    # 1 minute = 11 MiB per stream
+    # 1 minute = 1.2 MB per stream, allocated as the song plays
     MAX_REWIND_SECONDS = 60
+    # same for songs that FFmpeg outputs as PCM
+    # e.g. when played not at 100% volume, 10 seconds = 1.8 MiB
+    MAX_PCM_REWIND_SECONDS = 10
+    # fast-forwarding for longer or rewinding further than history
+    # restarts FFmpeg at the new position instead of skipping audio
+    SEEK_THRESHOLD = 30
+    # paused songs close FFmpeg after this many seconds
+    # and continue from the same position when resumed, 0 to disable
+    PAUSE_RELEASE_SECONDS = 300
+
+    # the next song is started this many seconds before
+    # the current one ends to play them without a gap, 0 to disable
+    GAPLESS_PRESPAWN_SECONDS = 5
+
+    # let FFmpeg encode songs played at 100% volume to Opus, so that
+    # the bot doesn't need to encode them while nothing else is playing
+    OPUS_FAST_PATH = True
+    # send Opus songs without re-encoding when possible
+    # disables loudness normalization for them
+    OPUS_PASSTHROUGH = False
+    # frames read from FFmpeg in advance,
+    # 1 frame = 20 ms, 0 to read them while playing
+    READ_AHEAD_FRAMES = 50
+    # guilds that start the same song at the same time share one FFmpeg
+    # late listeners of live streams join them at the current position
+    BROADCAST_MODE = False
+    # number of threads that send audio of all guilds,
+    # 0 to use a thread for each voice connection
+    AUDIO_SCHEDULER_THREADS = 0
+
+    # number of processes used to extract song info
+    LOADER_WORKERS = 1
+    # how many extractions can run simultaneously for one site
+    # (shared between all loader processes)
+    MAX_SITE_CONCURRENCY = 1
+
+    # file where extracted song info is stored between restarts
+    # set to empty string to disable
+    EXTRACTION_CACHE_PATH = "cache.db"
+    # seconds to keep info that doesn't have expiration time
+    EXTRACTION_CACHE_TTL = 3600
+
+    # directory where played songs are stored to avoid downloading them
+    # again, set to empty string to disable
+    # also required for loudness analysis, see below
+    AUDIO_CACHE_PATH = ""
+    # megabytes
+    AUDIO_CACHE_SIZE = 1024
+
+    # how many songs can be analyzed for loudness at the same time
+    # set to 0 to always normalize loudness while playing (more CPU usage)
+    # only songs stored in audio cache are analyzed, so without
+    # AUDIO_CACHE_PATH loudness is always normalized while playing
+    # results are stored in EXTRACTION_CACHE_PATH
+    LOUDNESS_ANALYSIS_CONCURRENCY = 1
+
+    # how many search queries to remember, set to 0 to disable
+    SEARCH_CACHE_SIZE = 1000
+    # seconds
+    SEARCH_CACHE_TTL = 3600
+
+    # how many YouTube searches for Spotify playlist songs
+    # can run at the same time
+    SPOTIFY_RESOLVE_CONCURRENCY = 2
+    # days after which YouTube videos found for Spotify songs
+    # are searched again, 0 = never
+    SPOTIFY_MATCH_MAX_AGE = 0
 
     # if database is not one of sqlite, postgres or MySQL
     # you need to provide the url in SQL Alchemy-supported format.
@@ -206,6 +280,20 @@ class Config:
         current_cfg["MAX_SONG_PRELOAD"] = min(
             current_cfg["MAX_SONG_PRELOAD"], 25
         )
+        for key in (
+            "LOADER_WORKERS",
+            "MAX_SITE_CONCURRENCY",
+            "SPOTIFY_RESOLVE_CONCURRENCY",
+            "PRELOAD_CONCURRENCY",
+            "STREAM_REFRESHES_PER_MINUTE",
+        ):
+            current_cfg[key] = max(current_cfg[key], 1)
+        for key in (
+            "LOUDNESS_ANALYSIS_CONCURRENCY",
+            "AUDIO_SCHEDULER_THREADS",
+            "READ_AHEAD_FRAMES",
+        ):
+            current_cfg[key] = max(current_cfg[key], 0)
 
         self.update(current_cfg)
         return current_cfg
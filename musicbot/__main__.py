@@ -7,6 +7,7 @@ from discord.ext import commands
 from config import config
 from musicbot import loader
 from musicbot.bot import MusicBot
+from musicbot.audiocontroller import load_voice_assets
 from musicbot.utils import check_dependencies
 
 initial_extensions = [
@@ -45,6 +46,7 @@ if __name__ == "__main__":
     print("Loading...")
 
     check_dependencies()
+    load_voice_assets()
     config.warn_unknown_vars()
     if config.has_missing:
         config.save()
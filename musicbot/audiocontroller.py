@@ -2,23 +2,41 @@ from __future__ import annotations
 
 import sys
 import asyncio
-from functools import wraps
-from itertools import islice
+from functools import lru_cache, wraps
 from collections import defaultdict, deque
 from inspect import isawaitable
 from traceback import print_exc
 from contextlib import contextmanager
 from datetime import datetime, timezone
-from typing import TYPE_CHECKING, Coroutine, Literal, Optional, Union
+from typing import (
+    TYPE_CHECKING,
+    AsyncIterator,
+    Coroutine,
+    List,
+    Literal,
+    Optional,
+    Union,
+)
 
 import discord
 
 from config import config
-from musicbot import loader, utils
+from musicbot import broadcast, loader, utils
 from musicbot.song import Song, SongError
-from musicbot.ffmpeg import FFmpegPCMAudio, AudioMixer
+from musicbot.ffmpeg import (
+    FFmpegOpusAudio,
+    FFmpegPCMAudio,
+    AudioMixer,
+    AudioPrebuffer,
+    MemoryAudio,
+    ReleasedAudio,
+    decode_ogg_opus,
+    audio_cache_key,
+    section_key,
+)
 from musicbot.context import InteractionContext
 from musicbot.playlist import Playlist, LoopMode, LoopState, PauseState
+from musicbot.preloader import QueuePreloader
 from musicbot.utils import (
     CheckError,
     StrEnum,
@@ -34,6 +52,8 @@ if TYPE_CHECKING:
 
 
 VC_CONNECT_TIMEOUT = 10
+# frames read in advance for gapless playback
+GAPLESS_BUFFER_FRAMES = 50
 
 PLAYLIST = object()
 EMPTY_PLAYLIST = object()
@@ -48,6 +68,17 @@ class VoiceAsset(StrEnum):
     WAIT = "wait.opus"
 
 
+@lru_cache(maxsize=None)
+def decode_voice_asset(voice_asset: VoiceAsset) -> bytes:
+    return decode_ogg_opus(asset(voice_asset))
+
+
+def load_voice_assets():
+    "Decodes voice assets once, so that playing them doesn't need FFmpeg"
+    for voice_asset in VoiceAsset:
+        decode_voice_asset(voice_asset)
+
+
 class MusicButton(discord.ui.Button):
     USAGE_HISTORY: defaultdict[int, deque[tuple[int, int, str]]] = defaultdict(
         lambda: deque(maxlen=100)
@@ -94,6 +125,7 @@ class AudioController(object):
     def __init__(self, bot: "MusicBot", guild: discord.Guild):
         self.bot = bot
         self.playlist = Playlist()
+        self.preloader = QueuePreloader(bot, self.playlist)
         self._next_song = None
         self.guild = guild
         self.mixer = None
@@ -111,6 +143,19 @@ class AudioController(object):
         # according to Python documentation, we need
         # to keep strong references to all tasks
         self._tasks = set()
+        # tasks that add the rest of playlists to the queue
+        # and resolve their songs, cancelled when the queue is cleared
+        self._playlist_tasks = set()
+        # waits for the end of current song to prepare the next one
+        self._gapless_task: Optional[asyncio.Task] = None
+        # song that is queued in the mixer after the current one
+        self._gapless_song: Optional[Song] = None
+        # closes FFmpeg of the current song if it stays paused
+        self._release_task: Optional[asyncio.Task] = None
+        # restarts FFmpeg of the released song
+        self._resume_task: Optional[asyncio.Task] = None
+        # whether the song is unpaused when the restart finishes
+        self._resuming = False
 
         self.command_lock = asyncio.Lock()
         self.message_lock = asyncio.Lock()
@@ -132,13 +177,17 @@ class AudioController(object):
     @volume.setter
     def volume(self, value: int):
         self._volume = value
-        try:
-            self.mixer.get_stream(0).source.volume = value / 100.0
-        except AttributeError:
-            pass
-        except Exception:
-            print("Unknown error when setting volume:", file=sys.stderr)
-            print_exc(file=sys.stderr)
+        if not self.mixer:
+            return
+        for stream in (self.mixer.get_stream(0), self.mixer.get_pending(0)):
+            if stream:
+                stream.volume = value / 100.0
+
+    def _wants_opus(self) -> bool:
+        """Whether FFmpeg should encode to Opus, which can't change volume
+        Songs that are already playing keep their output,
+        the mixer decodes Opus when the volume changes"""
+        return config.OPUS_FAST_PATH and self.volume == 100
 
     def volume_up(self):
         self.volume = min(self.volume + 10, 200)
@@ -290,6 +339,10 @@ class AudioController(object):
     def is_active(self) -> bool:
         return bool(self.mixer and self.mixer.get_stream(0))
 
+    def is_playing(self) -> bool:
+        "Whether the bot is sending audio, including voice assets"
+        return bool(self.mixer and self.mixer.is_playing())
+
     def track_history(self):
         history_string = config.INFO_HISTORY_TITLE
         for trackname in self.playlist.trackname_history:
@@ -298,11 +351,18 @@ class AudioController(object):
 
     def pause(self):
         if self.mixer and (stream := self.mixer.get_stream(0)):
-            if not stream.paused:
-                stream.paused = True
+            if not stream.paused or self._resuming:
+                # also keeps the released song paused after its restart
+                self._resuming = False
+                self.mixer.pause_stream(0)
                 self.add_task(self.timer.start(True))
+                self._release_paused_stream()
                 return PauseState.PAUSED
-            stream.paused = False
+            self._cancel_release()
+            if self._is_released():
+                self._resume_released(self.position)
+            else:
+                self.mixer.resume_stream(0)
             return PauseState.RESUMED
         return PauseState.NOTHING_TO_PAUSE
 
@@ -319,6 +379,7 @@ class AudioController(object):
             return LoopState.INVALID
 
         self.playlist.loop = mode
+        self._check_gapless()
 
         if mode == LoopMode.OFF:
             return LoopState.DISABLED
@@ -328,26 +389,165 @@ class AudioController(object):
         self.playlist.shuffle()
         self.preload_queue()
 
-    def fast_forward(self, seconds: int) -> None:
+    @property
+    def position(self) -> Optional[float]:
+        "Position in the current song in seconds"
         if self.mixer:
-            self.add_task(
-                asyncio.get_running_loop().run_in_executor(
-                    None,
-                    lambda: self.mixer.fast_forward_stream(
-                        0, seconds * self.mixer.FRAMES_PER_SECOND
-                    ),
-                )
+            return self.mixer.get_position(0)
+        return None
+
+    def _can_seek(self) -> bool:
+        song = self.current_song
+        # live streams can't be seeked
+        return bool(song and song.played_duration and self.is_active())
+
+    def fast_forward(self, seconds: int) -> None:
+        if not self.mixer:
+            return
+        if self._is_released():
+            self._resume_released(self.position + seconds)
+            return
+        if (
+            seconds > config.SEEK_THRESHOLD or self._is_broadcast()
+        ) and self._can_seek():
+            self.add_task(self.seek(self.position + seconds))
+            return
+        if self._is_broadcast():
+            # reading ahead would make the shared FFmpeg run faster
+            # than realtime, other guilds would lose frames
+            return
+        self.add_task(
+            asyncio.get_running_loop().run_in_executor(
+                None,
+                lambda: self.mixer.fast_forward_stream(
+                    0, seconds * self.mixer.FRAMES_PER_SECOND
+                ),
             )
+        )
 
     def rewind(self, seconds: int) -> int:
-        if self.mixer:
-            return round(
-                self.mixer.rewind_stream(
-                    0, seconds * self.mixer.FRAMES_PER_SECOND
-                )
-                / self.mixer.FRAMES_PER_SECOND
+        if not self.mixer:
+            return 0
+        frame_count = seconds * self.mixer.FRAMES_PER_SECOND
+        if self._is_released():
+            position = self.position
+            target = max(position - seconds, 0)
+            self._resume_released(target)
+            return round(position - target)
+        if (
+            # the shared FFmpeg can't wait until the rewind ends
+            self._is_broadcast()
+            # the history is too short
+            or seconds > config.SEEK_THRESHOLD
+            and len(self.mixer.rewinds[0]) < frame_count
+        ) and self._can_seek():
+            position = self.position
+            target = max(position - seconds, 0)
+            self.add_task(self.seek(target))
+            return round(position - target)
+        return round(
+            self.mixer.rewind_stream(0, frame_count)
+            / self.mixer.FRAMES_PER_SECOND
+        )
+
+    async def seek(self, position: float):
+        "Restarts FFmpeg for the current song at position in seconds"
+        song = self.current_song
+        if not song or not await loader.preload(song, self.bot):
+            return
+        try:
+            audio = await self._open_audio(song, seek=position)
+        except SongError:
+            print("Failed to seek:", file=sys.stderr)
+            print_exc(file=sys.stderr)
+            return
+        if not (
+            self.mixer
+            and self.current_song is song
+            and self.mixer.replace_source(0, audio, position)
+        ):
+            audio.cleanup()
+
+    def _is_broadcast(self) -> bool:
+        "Whether the current song is read from FFmpeg shared with others"
+        stream = self.mixer and self.mixer.get_stream(0)
+        return bool(
+            stream and isinstance(stream.source, broadcast.BroadcastSubscriber)
+        )
+
+    def _is_released(self) -> bool:
+        stream = self.mixer and self.mixer.get_stream(0)
+        return bool(stream and isinstance(stream.source, ReleasedAudio))
+
+    def _release_paused_stream(self):
+        stream = self.mixer.get_stream(0)
+        if self._is_broadcast():
+            # other guilds keep reading the shared FFmpeg,
+            # continue from the same position with own one
+            self._release(stream.position)
+        else:
+            self._schedule_release()
+
+    def _schedule_release(self):
+        self._cancel_release()
+        if config.PAUSE_RELEASE_SECONDS and self.current_song:
+            self._release_task = self.bot.loop.create_task(
+                self._release_paused(self.current_song)
+            )
+            self.add_task(self._release_task)
+
+    def _cancel_release(self):
+        if self._release_task:
+            self._release_task.cancel()
+            self._release_task = None
+
+    async def _release_paused(self, song: Song):
+        "Closes FFmpeg of the song if it's still paused after a while"
+        await asyncio.sleep(config.PAUSE_RELEASE_SECONDS)
+        self._release_task = None
+        stream = self.mixer and self.mixer.get_stream(0)
+        if not stream or not stream.paused or self.current_song is not song:
+            return
+        self._release(stream.position)
+
+    def _release(self, position: float):
+        "Closes FFmpeg of the paused song, resuming starts it at position"
+        # the next song would be started again on resume
+        self._cancel_gapless()
+        self.mixer.replace_source(0, ReleasedAudio(), position)
+
+    def _resume_released(self, position: float):
+        self._resuming = True
+        if not self._resume_task:
+            self._resume_task = self.bot.loop.create_task(
+                self._restart_released(position)
             )
-        return 0
+            self.add_task(self._resume_task)
+
+    async def _restart_released(self, position: float):
+        "Starts FFmpeg of the released song at position and unpauses it"
+        song = self.current_song
+        try:
+            # the stream URL could expire during the pause
+            if song:
+                await loader.preload(song, self.bot, refresh=True)
+            # live streams can only continue from the current moment
+            await self.seek(position if self._can_seek() else 0)
+        finally:
+            self._resume_task = None
+            resuming, self._resuming = self._resuming, False
+        if not self.mixer or self.current_song is not song:
+            return
+        if self._is_released():
+            # couldn't start it again, move on
+            self.mixer.stop_stream(0)
+            return
+        if not resuming:
+            # paused again while FFmpeg was starting
+            self._release_paused_stream()
+            return
+        self.mixer.resume_stream(0)
+        self._schedule_gapless(song)
 
     @staticmethod
     def needs_waiting(func):
@@ -425,12 +625,7 @@ class AudioController(object):
                 self.next_song(forced=True)
                 return
 
-            audio = FFmpegPCMAudio(await loader.get_ffmpeg_args(song))
-            # FFmpeg needs some time when seeking, ensure it's ready
-            await asyncio.get_running_loop().run_in_executor(None, audio.read)
-            audio._check_process_returncode()
-            if error := audio._current_error:
-                raise SongError(config.SONGINFO_ERROR) from error
+            audio = await self._open_audio(song)
         finally:
             self.stop_waiting()
 
@@ -445,18 +640,22 @@ class AudioController(object):
 
         try:
             self.mixer.add_stream(
-                discord.PCMVolumeTransformer(
-                    audio,
-                    self.volume / 100.0,
-                ),
+                audio,
                 id_=0,
                 after=self.next_song,
                 rewindable=True,
+                volume=self.volume / 100.0,
             )
         except discord.ClientException:
+            audio.cleanup()
             await self.udisconnect()
             return
 
+        await self._song_started(song)
+
+    async def _song_started(self, song: Song):
+        self._schedule_gapless(song)
+
         if (
             self.bot.settings[self.guild].announce_songs
             and self.command_channel
@@ -467,6 +666,140 @@ class AudioController(object):
 
         self.preload_queue()
 
+    async def _open_audio(
+        self, song: Song, frame_count: int = 1, seek: float = 0
+    ) -> discord.AudioSource:
+        "Starts FFmpeg for the preloaded song and waits for its first frames"
+        if seek:
+            input_args = loader.get_ffmpeg_args(song, seek)
+        else:
+            input_args = song.ffmpeg_args or loader.get_ffmpeg_args(song)
+
+        # decoding Opus to change volume costs more than PCM output
+        opus = self._wants_opus()
+
+        def create_source() -> discord.AudioSource:
+            if opus:
+                return FFmpegOpusAudio(
+                    input_args,
+                    audio_cache_key(song),
+                    seek,
+                    song.loudness_gain,
+                    copy=config.OPUS_PASSTHROUGH
+                    and song.data.get("acodec") == "opus",
+                )
+            return FFmpegPCMAudio(
+                input_args, audio_cache_key(song), seek, song.loudness_gain
+            )
+
+        if config.BROADCAST_MODE and not seek:
+            # share FFmpeg with other guilds playing the same song
+            audio = broadcast.subscribe(
+                (section_key(song), song.loudness_gain, opus),
+                create_source,
+                bool(song.data.get("is_live")),
+            )
+        else:
+            audio = AudioPrebuffer(create_source())
+        try:
+            # FFmpeg needs some time when seeking, ensure it's ready
+            await asyncio.get_running_loop().run_in_executor(
+                None, audio.fill, frame_count
+            )
+            audio.source._check_process_returncode()
+            if error := audio.source._current_error:
+                raise SongError(config.SONGINFO_ERROR) from error
+        except BaseException:
+            audio.cleanup()
+            raise
+        return audio
+
+    def _schedule_gapless(self, song: Song):
+        self._cancel_gapless()
+        if config.GAPLESS_PRESPAWN_SECONDS and song.played_duration:
+            self._gapless_task = self.bot.loop.create_task(
+                self._prepare_gapless(song)
+            )
+            self.add_task(self._gapless_task)
+
+    def _cancel_gapless(self):
+        if self._gapless_task:
+            self._gapless_task.cancel()
+            self._gapless_task = None
+        self._gapless_song = None
+        if self.mixer:
+            self.mixer.unqueue_stream(0)
+
+    def _check_gapless(self):
+        "Replaces the queued song if the queue has changed"
+        if (
+            self._gapless_song
+            and self._gapless_song is not self.playlist.peek_next()
+        ):
+            if self.current_song:
+                self._schedule_gapless(self.current_song)
+            else:
+                self._cancel_gapless()
+
+    async def _prepare_gapless(self, song: Song):
+        """Starts the next song shortly before the current one ends
+        and queues it in the mixer to switch without a gap"""
+        while True:
+            stream = self.mixer and self.mixer.get_stream(0)
+            if not stream:
+                return
+            remaining = (
+                song.played_duration
+                - stream.position
+                - config.GAPLESS_PRESPAWN_SECONDS
+            )
+            if remaining <= 0:
+                break
+            # the stream may be paused or seeked meanwhile
+            await asyncio.sleep(min(max(remaining, 1), 5))
+
+        next_song = self.playlist.peek_next()
+        if next_song is None or not await loader.preload(next_song, self.bot):
+            return
+        try:
+            audio = await self._open_audio(next_song, GAPLESS_BUFFER_FRAMES)
+        except SongError:
+            # will be handled when the song is played normally
+            return
+
+        if not (
+            self.mixer
+            and next_song is self.playlist.peek_next()
+            and self.mixer.queue_stream(
+                audio,
+                id_=0,
+                after=self.next_song,
+                before=lambda: self.bot.loop.call_soon_threadsafe(
+                    self._gapless_started, next_song
+                ),
+                rewindable=True,
+                volume=self.volume / 100.0,
+            )
+        ):
+            audio.cleanup()
+            return
+        self._gapless_song = next_song
+        self._gapless_task = None
+
+    def _gapless_started(self, song: Song):
+        "Invoked when the mixer switches to the queued song"
+        self._gapless_song = None
+        if self.playlist:
+            self.playlist.add_name(self.playlist[0].title)
+        next_song = self.playlist.next()
+        if next_song is not song:
+            # the queue changed at the last moment
+            self._next_song = next_song
+            if self.mixer:
+                self.mixer.stop_stream(0)
+            return
+        self.add_task(self._song_started(song))
+
     @needs_waiting
     async def process_song(
         self, track: str
@@ -474,7 +807,8 @@ class AudioController(object):
         """Adds the track to the playlist instance
         Starts playing if it is the first song"""
 
-        loaded_song = await loader.load_song(track)
+        batches = loader.load_song_batches(track)
+        loaded_song = await anext(batches)
         if loaded_song is None:
             return None
         elif not loaded_song:
@@ -485,10 +819,17 @@ class AudioController(object):
         else:
             for song in loaded_song:
                 self.playlist.add(song)
+            self._add_playlist_task(
+                loader.resolve_spotify(loaded_song, self.bot, self.playlist)
+            )
             if len(loaded_song) == 1:
                 # special-case one-item playlists
                 loaded_song = loaded_song[0]
             else:
+                # start playing without waiting for the whole playlist
+                self._add_playlist_task(
+                    self._load_playlist_rest(batches, len(loaded_song))
+                )
                 loaded_song = PLAYLIST
 
         if not self.is_active():
@@ -499,6 +840,55 @@ class AudioController(object):
 
         return loaded_song
 
+    async def _load_playlist_rest(
+        self, batches: AsyncIterator[List[Song]], tracks_number: int
+    ):
+        message = None
+        text = config.SONGINFO_PLAYLIST_LOADED
+        failed = False
+        try:
+            async for loaded_songs in batches:
+                if not loaded_songs:
+                    continue
+                for song in loaded_songs:
+                    self.playlist.add(song)
+                self._add_playlist_task(
+                    loader.resolve_spotify(
+                        loaded_songs, self.bot, self.playlist
+                    )
+                )
+                tracks_number += len(loaded_songs)
+                self.preload_queue()
+                message = await self._send_progress(
+                    message,
+                    config.SONGINFO_PLAYLIST_LOADING.format(
+                        tracks_number=tracks_number
+                    ),
+                )
+        except Exception:
+            print("Failed to load the rest of playlist:", file=sys.stderr)
+            print_exc(file=sys.stderr)
+            text = config.SONGINFO_PLAYLIST_FAILED
+            failed = True
+        # the user should know that some songs are missing
+        if message or failed:
+            await self._send_progress(
+                message, text.format(tracks_number=tracks_number)
+            )
+
+    async def _send_progress(
+        self, message: Optional[discord.Message], text: str
+    ) -> Optional[discord.Message]:
+        try:
+            if message is None:
+                if self.command_channel is None:
+                    return None
+                return await self.command_channel.send(text)
+            await message.edit(content=text)
+        except discord.HTTPException:
+            print_exc(file=sys.stderr)
+        return message
+
     def add_task(self, coro: Coroutine | asyncio.Future):
         if isinstance(coro, asyncio.Future):
             task = coro
@@ -507,30 +897,35 @@ class AudioController(object):
         self._tasks.add(task)
         task.add_done_callback(self._tasks.remove)
 
-    async def _preload_queue(self):
-        rerun_needed = False
-        for song in list(
-            islice(self.playlist.playque, 1, config.MAX_SONG_PRELOAD)
-        ):
-            if not await loader.preload(song, self.bot):
-                try:
-                    self.playlist.playque.remove(song)
-                    rerun_needed = True
-                except ValueError:
-                    # already removed
-                    pass
-        if rerun_needed:
-            self.add_task(self._preload_queue())
+    def _add_playlist_task(self, coro: Coroutine):
+        task = self.bot.loop.create_task(coro)
+        self._playlist_tasks.add(task)
+        task.add_done_callback(self._playlist_tasks.remove)
+        self.add_task(task)
 
     def preload_queue(self):
         "Preloads the first MAX_SONG_PRELOAD songs asynchronously"
-        self.add_task(self._preload_queue())
+        self.preloader.schedule()
+        self._check_gapless()
+
+    def clear_queue(self):
+        "Removes all songs except the current one from the queue"
+        for task in self._playlist_tasks:
+            task.cancel()
+        self.playlist.clear()
+        self.preload_queue()
 
     def stop_player(self):
         """Stops the player and removes all songs from the queue"""
+        for task in self._playlist_tasks:
+            task.cancel()
         self.playlist.loop = LoopMode.OFF
         self.playlist.clear()
         self.playlist.next()
+        # cancel preloading of removed songs
+        self.preload_queue()
+        self._cancel_gapless()
+        self._cancel_release()
 
         if not self.is_active():
             return
@@ -558,7 +953,7 @@ class AudioController(object):
         sett = self.bot.settings[self.guild]
 
         if sett.vc_timeout and (
-            not self.guild.voice_client.is_playing()
+            not self.is_playing()
             or all(m.bot for m in self.guild.voice_client.channel.members)
         ):
             await self.udisconnect()
@@ -567,12 +962,10 @@ class AudioController(object):
         self.current_voice_asset = voice_asset
         future = asyncio.Future()
         self.mixer.add_stream(
-            discord.PCMVolumeTransformer(
-                discord.FFmpegPCMAudio(asset(voice_asset)),
-                self.volume / 100.0,
-            ),
+            MemoryAudio(decode_voice_asset(voice_asset)),
             id_=-1,
             after=lambda: future.cancelled() or future.set_result(None),
+            volume=self.volume / 100.0,
         )
         self.voice_asset_future = future
         self.voice_asset_future.add_done_callback(
@@ -637,6 +1030,8 @@ class AudioController(object):
         self._waiting = False
         await self.update_view(None)
         if (client := self.guild.voice_client) is None:
+            if self.mixer:
+                self.mixer.stop()
             self.mixer = None
             return False
         if config.ANNOUNCE_DISCONNECT and client.is_connected():
@@ -648,6 +1043,8 @@ class AudioController(object):
             else:
                 # let it finish
                 await asyncio.sleep(1)
+        if self.mixer:
+            self.mixer.stop()
         self.mixer = None
         await client.disconnect(force=True)
         self.timer.cancel()
@@ -139,9 +139,7 @@ class MusicBot(commands.Bot):
         if member == self.user:
             audiocontroller = self.audio_controllers[guild]
             if after.channel is not None:
-                await audiocontroller.timer.start(
-                    guild.voice_client.is_playing()
-                )
+                await audiocontroller.timer.start(audiocontroller.is_playing())
             else:
                 await asyncio.sleep(5)
                 if (
@@ -159,7 +157,7 @@ class MusicBot(commands.Bot):
         ):
             # all users left
             audiocontroller = self.audio_controllers[guild]
-            await audiocontroller.timer.start(guild.voice_client.is_playing())
+            await audiocontroller.timer.start(audiocontroller.is_playing())
 
     @tasks.loop(seconds=1)
     async def update_views(self):
@@ -0,0 +1,166 @@
+import sys
+import threading
+from collections import deque
+from traceback import print_exc
+from typing import Callable, Dict, Hashable, Set
+
+from discord import AudioSource
+from discord.player import OPUS_SILENCE
+from discord.opus import Encoder as OpusEncoder
+
+# subscribers ask for more frames when they have less than this
+LOW_WATERMARK = 25
+# late subscribers receive this many recent frames
+HISTORY_FRAMES = 250
+# frames a subscriber can lag behind before losing the oldest ones
+MAX_FRAMES = HISTORY_FRAMES + LOW_WATERMARK * 2
+PCM_SILENCE = b"\0" * OpusEncoder.FRAME_SIZE
+
+_broadcasts: Dict[Hashable, "Broadcast"] = {}
+_lock = threading.Lock()
+
+
+class Broadcast:
+    """Reads one source and sends its frames to several subscribers
+    Reading is driven by the subscriber that is the furthest ahead,
+    those that fall behind lose their oldest frames,
+    so subscribers that pause or seek should switch to their own source"""
+
+    def __init__(self, key: Hashable, source: AudioSource, live: bool):
+        self.key = key
+        self.source = source
+        self.live = live
+        self.frames_read = 0
+        self.ended = False
+        self.subscribers: Set[BroadcastSubscriber] = set()
+        self.history: deque[bytes] = deque(maxlen=HISTORY_FRAMES)
+        self._condition = threading.Condition(_lock)
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @property
+    def joinable(self) -> bool:
+        # others would miss the beginning of a song
+        return not self.ended and (
+            self.live or self.frames_read == len(self.history)
+        )
+
+    def _needs_frames(self) -> bool:
+        return any(
+            len(subscriber.frames) < subscriber.watermark
+            for subscriber in self.subscribers
+        )
+
+    def _run(self):
+        try:
+            while True:
+                with self._condition:
+                    self._condition.wait_for(
+                        lambda: self._stopped or self._needs_frames()
+                    )
+                    if self._stopped:
+                        break
+                frame = self.source.read()
+                with self._condition:
+                    if not frame:
+                        self.ended = True
+                        self._condition.notify_all()
+                        break
+                    # the source may reuse the buffer of the frame
+                    frame = bytes(frame)
+                    if self.live or self.joinable:
+                        self.history.append(frame)
+                    self.frames_read += 1
+                    for subscriber in self.subscribers:
+                        subscriber.frames.append(frame)
+                    self._condition.notify_all()
+        except Exception:
+            print_exc(file=sys.stderr)
+            with self._condition:
+                self.ended = True
+                self._condition.notify_all()
+        finally:
+            self.source.cleanup()
+
+    def _subscribe(self) -> "BroadcastSubscriber":
+        # called with the lock held
+        subscriber = BroadcastSubscriber(self)
+        subscriber.frames.extend(self.history)
+        self.subscribers.add(subscriber)
+        self._condition.notify_all()
+        return subscriber
+
+    def _unsubscribe(self, subscriber: "BroadcastSubscriber"):
+        with self._condition:
+            self.subscribers.discard(subscriber)
+            if self.subscribers:
+                return
+            self._stopped = True
+            if _broadcasts.get(self.key) is self:
+                del _broadcasts[self.key]
+            self._condition.notify_all()
+
+
+class BroadcastSubscriber(AudioSource):
+    def __init__(self, broadcast: Broadcast):
+        self.broadcast = broadcast
+        self.frames: deque[bytes] = deque(maxlen=MAX_FRAMES)
+        self.watermark = LOW_WATERMARK
+        self._subscribed = True
+
+    @property
+    def source(self) -> AudioSource:
+        return self.broadcast.source
+
+    def fill(self, frame_count: int) -> None:
+        "Blocks until frame_count frames are received or the source ends"
+        broadcast = self.broadcast
+        frame_count = min(frame_count, MAX_FRAMES)
+        with broadcast._condition:
+            self.watermark = max(frame_count, LOW_WATERMARK)
+            broadcast._condition.notify_all()
+            broadcast._condition.wait_for(
+                lambda: broadcast.ended or len(self.frames) >= frame_count
+            )
+            self.watermark = LOW_WATERMARK
+
+    def read(self) -> bytes:
+        broadcast = self.broadcast
+        with broadcast._condition:
+            if len(self.frames) <= self.watermark:
+                broadcast._condition.notify_all()
+            if self.frames:
+                return self.frames.popleft()
+            if broadcast.ended:
+                return b""
+        # the source is late, keep the stream alive
+        return OPUS_SILENCE if self.is_opus() else PCM_SILENCE
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def cleanup(self) -> None:
+        if self._subscribed:
+            self._subscribed = False
+            self.broadcast._unsubscribe(self)
+
+
+def subscribe(
+    key: Hashable, create_source: Callable[[], AudioSource], live: bool
+) -> BroadcastSubscriber:
+    """Subscribes to the broadcast with the key
+    If there is none or it can't be joined, starts a new one,
+    create_source is called to make its source"""
+    with _lock:
+        broadcast = _broadcasts.get(key)
+        if broadcast is not None and broadcast.joinable:
+            return broadcast._subscribe()
+
+    source = create_source()
+    with _lock:
+        broadcast = Broadcast(key, source, live)
+        # the old one continues for its subscribers
+        _broadcasts[key] = broadcast
+        subscriber = broadcast._subscribe()
+    broadcast._thread.start()
+    return subscriber
@@ -0,0 +1,275 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from yt_dlp import YoutubeDL
+
+# parts of info dict that are not used after extraction
+HEAVY_KEYS = (
+    "formats",
+    "automatic_captions",
+    "subtitles",
+    "requested_subtitles",
+    "heatmap",
+    "chapters",
+    "description",
+    "tags",
+    "categories",
+)
+
+
+def slim_info(data: dict) -> dict:
+    "Remove unused data from info dict to make it smaller"
+    data = {k: v for k, v in data.items() if k not in HEAVY_KEYS}
+    thumbnails = data.get("thumbnails")
+    if thumbnails:
+        # only the best one is displayed
+        data["thumbnails"] = thumbnails[-1:]
+    return YoutubeDL.sanitize_info(data)
+
+
+class ExtractionCache:
+    """Stores extracted info in SQLite database
+    Safe to use from multiple processes"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS extractions"
+                " (url TEXT PRIMARY KEY, data TEXT, expires REAL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS loudness"
+                " (url TEXT PRIMARY KEY, integrated REAL, true_peak REAL)"
+            )
+            connection.execute(
+                "DELETE FROM extractions WHERE expires <= ?", (time.time(),)
+            )
+            connection.commit()
+            self._local.connection = connection
+        return connection
+
+    def get(self, url: str) -> Optional[dict]:
+        row = self._connection.execute(
+            "SELECT data FROM extractions WHERE url = ? AND expires > ?",
+            (url, time.time()),
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def set(self, url: str, data: dict, expires: float) -> None:
+        if expires <= time.time():
+            return
+        with self._connection as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO extractions VALUES (?, ?, ?)",
+                (url, json.dumps(slim_info(data)), expires),
+            )
+
+    def get_loudness(self, url: str) -> Optional[Tuple[float, float]]:
+        "Returns integrated loudness and true peak measured for the URL"
+        return self._connection.execute(
+            "SELECT integrated, true_peak FROM loudness WHERE url = ?", (url,)
+        ).fetchone()
+
+    def set_loudness(
+        self, url: str, integrated: float, true_peak: float
+    ) -> None:
+        # the loudness doesn't change, so it's stored forever
+        with self._connection as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO loudness VALUES (?, ?, ?)",
+                (url, integrated, true_peak),
+            )
+
+
+class SearchCache:
+    """In-memory LRU cache for search results
+    Results for bigger count can be used for smaller ones"""
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # query -> (expiration time, requested count, results)
+        self._entries: OrderedDict[str, Tuple[float, int, List[dict]]] = (
+            OrderedDict()
+        )
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return " ".join(query.casefold().split())
+
+    def get(self, query: str, count: int) -> Optional[List[dict]]:
+        key = self.normalize(query)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.time() or entry[1] < count:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        # callers are allowed to modify the results
+        return [dict(result) for result in entry[2][:count]]
+
+    def set(self, query: str, count: int, results: List[dict]) -> None:
+        if self.size <= 0:
+            return
+        key = self.normalize(query)
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > now and entry[1] > count:
+            # keep the more complete results
+            return
+        self._entries[key] = (
+            now + self.ttl,
+            count,
+            [dict(result) for result in results],
+        )
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def __str__(self) -> str:
+        return (
+            f"Search cache: {len(self._entries)}/{self.size} entries,"
+            f" {self.hits} hits, {self.misses} misses"
+        )
+
+
+class AudioCache:
+    """Stores transcoded songs in a directory
+    The least recently used files are removed to fit into max_bytes"""
+
+    SUFFIX = ".ogg"
+    TEMP_SUFFIX = ".tmp"
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # file name -> size, the least recently used first
+        self._files: Optional[OrderedDict[str, int]] = None
+
+    def _get_files(self) -> OrderedDict[str, int]:
+        # the directory is scanned on first use,
+        # so that loader processes don't do it
+        if self._files is not None:
+            return self._files
+        os.makedirs(self.path, exist_ok=True)
+        found: Dict[str, Tuple[float, int]] = {}
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(self.TEMP_SUFFIX):
+                # left after crash
+                self._remove(entry.name)
+            elif entry.name.endswith(self.SUFFIX):
+                stat = entry.stat()
+                found[entry.name] = (stat.st_mtime, stat.st_size)
+        self._files = OrderedDict(
+            (name, size)
+            for name, (_, size) in sorted(
+                found.items(), key=lambda item: item[1][0]
+            )
+        )
+        self._evict()
+        return self._files
+
+    def _name(self, key: str) -> str:
+        return hashlib.sha1(key.encode()).hexdigest() + self.SUFFIX
+
+    def _remove(self, name: str) -> None:
+        try:
+            os.remove(os.path.join(self.path, name))
+        except OSError:
+            pass
+
+    def _evict(self) -> None:
+        total = sum(self._files.values())
+        while total > self.max_bytes and self._files:
+            name, size = self._files.popitem(last=False)
+            self._remove(name)
+            total -= size
+
+    def get(self, key: str) -> Optional[str]:
+        "Returns path of the cached file or None"
+        name = self._name(key)
+        path = os.path.join(self.path, name)
+        with self._lock:
+            files = self._get_files()
+            if name in files:
+                try:
+                    # remember the order between restarts
+                    os.utime(path)
+                except OSError:
+                    del files[name]
+                else:
+                    files.move_to_end(name)
+                    self.hits += 1
+                    return path
+            self.misses += 1
+        return None
+
+    def peek(self, key: str) -> Optional[str]:
+        """Returns path of the cached file or None
+        Unlike get(), doesn't mark the file as used or count it"""
+        name = self._name(key)
+        with self._lock:
+            if name in self._get_files():
+                return os.path.join(self.path, name)
+        return None
+
+    def new_file(self) -> str:
+        "Returns path for a file that can be added with add()"
+        with self._lock:
+            self._get_files()
+        fd, path = tempfile.mkstemp(self.TEMP_SUFFIX, dir=self.path)
+        os.close(fd)
+        return path
+
+    def add(self, key: str, temp_path: str) -> None:
+        name = self._name(key)
+        try:
+            size = os.path.getsize(temp_path)
+            os.replace(temp_path, os.path.join(self.path, name))
+        except OSError:
+            self.discard(temp_path)
+            return
+        with self._lock:
+            files = self._get_files()
+            files[name] = size
+            files.move_to_end(name)
+            self._evict()
+
+    @staticmethod
+    def discard(temp_path: str) -> None:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+    def __str__(self) -> str:
+        files = self._files or {}
+        return (
+            f"Audio cache: {len(files)} files,"
+            f" {sum(files.values()) / 2**20:.1f}"
+            f"/{self.max_bytes / 2**20:.0f} MiB,"
+            f" {self.hits} hits, {self.misses} misses"
+        )
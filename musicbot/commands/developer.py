@@ -12,6 +12,8 @@ from discord.app_commands import Choice
 from aioconsole import aexec
 
 from config import config
+from musicbot import loader
+from musicbot.ffmpeg import audio_cache, read_ahead_stats
 from musicbot.bot import Context, MusicBot
 from musicbot.utils import Paginator
 
@@ -100,6 +102,21 @@ class Developer(commands.Cog):
             if not suppress:
                 await ctx.send("No output.")
 
+    @commands.command(
+        name="stats",
+        hidden=True,
+    )
+    @commands.is_owner()
+    async def _stats(self, ctx: Context):
+        lines = [
+            str(loader.stats),
+            str(loader.search_cache),
+            str(read_ahead_stats),
+        ]
+        if audio_cache:
+            lines.append(str(audio_cache))
+        await ctx.send("```\n" + "\n".join(lines) + "```")
+
     @commands.hybrid_group(
         name="guild_whitelist",
         aliases=("gw",),
@@ -1,5 +1,6 @@
 import json
 import asyncio
+from datetime import timedelta
 from typing import Awaitable, Callable, Iterable, Union, Optional
 
 from discord import Attachment, Embed, Interaction
@@ -376,7 +377,7 @@ class Music(commands.Cog):
         aliases=["cl"],
     )
     async def _clear(self, ctx: AudioContext):
-        ctx.audiocontroller.playlist.clear()
+        ctx.audiocontroller.clear_queue()
         await ctx.send("Cleared queue :no_entry_sign:")
 
     @commands.hybrid_command(
@@ -401,7 +402,15 @@ class Music(commands.Cog):
     @active_only
     async def _songinfo(self, ctx: AudioContext):
         song = ctx.audiocontroller.current_song
-        await ctx.send(embed=song.format_output(config.SONGINFO_SONGINFO))
+        embed = song.format_output(config.SONGINFO_SONGINFO)
+        position = ctx.audiocontroller.position
+        if position is not None:
+            embed.add_field(
+                name=config.SONGINFO_POSITION,
+                value=str(timedelta(seconds=int(position))),
+                inline=False,
+            )
+        await ctx.send(embed=embed)
 
     @override_check(channel_check)
     @commands.hybrid_command(
@@ -1,135 +1,696 @@
+import os
+import re
 import sys
 import time
-import inspect
 import threading
 import subprocess
+from abc import ABC, abstractmethod
 from queue import deque
-from functools import reduce
 from traceback import print_exc
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from weakref import WeakSet
 from collections import defaultdict
+from http.cookiejar import CookieJar
 from typing import Callable, Dict, Optional, List, Tuple, Iterable
 from concurrent.futures import Future
 
-import yt_dlp
-import audioop
-from discord import AudioSource, FFmpegPCMAudio as BasePCMAudio, VoiceClient
-from discord.opus import Encoder as OpusEncoder
+import numpy as np
+from discord import (
+    AudioSource,
+    FFmpegOpusAudio as BaseOpusAudio,
+    FFmpegPCMAudio as BasePCMAudio,
+    VoiceClient,
+)
+from discord.oggparse import OggStream
+from discord.opus import Decoder as OpusDecoder, Encoder as OpusEncoder
 
 from config import config
 from musicbot.song import Song
+from musicbot.cache import AudioCache
+from musicbot.scheduler import AudioScheduler
+from musicbot.linkutils import normalize_url
+
+# input options and environment for FFmpeg
+InputArgs = Tuple[List[str], Optional[dict]]
+
+RECONNECT_ARGS = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+# loudness normalization targets, same as defaults of loudnorm filter
+TARGET_LOUDNESS = -24.0
+TARGET_TRUE_PEAK = -2.0
+# used to store songs in audio cache
+CACHE_OUTPUT_ARGS = "-vn -c:a libopus -b:a 128k -f ogg"
+CACHE_BITRATE = 128_000
+# Ogg Opus packets that don't contain audio
+OPUS_HEADERS = (b"OpusHead", b"OpusTags")
+_http_regex = re.compile(r"https?://")
+
+audio_cache = (
+    AudioCache(config.AUDIO_CACHE_PATH, config.AUDIO_CACHE_SIZE * 2**20)
+    if config.AUDIO_CACHE_PATH
+    else None
+)
+audio_scheduler = (
+    AudioScheduler(config.AUDIO_SCHEDULER_THREADS)
+    if config.AUDIO_SCHEDULER_THREADS
+    else None
+)
 
-OriginalArgs = Tuple[List[str], Optional[dict]]
 
-downloader_class = yt_dlp.get_external_downloader("ffmpeg")
-_downloader_module = inspect.getmodule(downloader_class)
-_original_popen = _downloader_module.Popen
-_dummy_process = _original_popen(
-    ["ffmpeg", "-version"], stdout=subprocess.PIPE
-)
+def _select_format(info: dict) -> dict:
+    formats = info.get("requested_formats")
+    if not formats:
+        return info
+    # only audio is played, take the first format that has it
+    for fmt in formats:
+        if fmt.get("acodec") != "none":
+            return fmt
+    return formats[0]
+
+
+def _rtmp_args(fmt: dict) -> List[str]:
+    args = []
+    for key, option in (
+        ("player_url", "-rtmp_swfverify"),
+        ("page_url", "-rtmp_pageurl"),
+        ("app", "-rtmp_app"),
+        ("play_path", "-rtmp_playpath"),
+        ("tc_url", "-rtmp_tcurl"),
+        ("flash_version", "-rtmp_flashver"),
+    ):
+        if fmt.get(key) is not None:
+            args += [option, fmt[key]]
+    if fmt.get("rtmp_live"):
+        args += ["-rtmp_live", "live"]
+    conn = fmt.get("rtmp_conn")
+    if isinstance(conn, str):
+        conn = [conn]
+    for entry in conn or ():
+        args += ["-rtmp_conn", entry]
+    return args
+
+
+def build_input_args(
+    info: dict,
+    cookiejar: Optional[CookieJar] = None,
+    proxy: Optional[str] = None,
+    seek: float = 0,
+) -> InputArgs:
+    """Converts extracted info to FFmpeg input options
+    Follows what yt-dlp's FFmpegFD does when downloading to stdout,
+    but depends only on the info dict, so works with recorded ones
+    seek is the position in seconds from the start of played section"""
+    args = []
+    # deprecated in yt-dlp, but still set by some extractors
+    args += info.get("_ffmpeg_args") or []
+    seekable = info.get("_seekable")
+    if seekable is not None:
+        args += ["-seekable", "1" if seekable else "0"]
+
+    fmt = _select_format(info)
+    url = fmt["url"]
+    if _http_regex.match(url):
+        args += RECONNECT_ARGS.split()
+        cookies = cookiejar.get_cookies_for_url(url) if cookiejar else []
+        if cookies:
+            args += [
+                "-cookies",
+                "".join(
+                    f"{cookie.name}={cookie.value}; path={cookie.path};"
+                    f" domain={cookie.domain};\r\n"
+                    for cookie in cookies
+                ),
+            ]
+        http_headers = fmt.get("http_headers") or info.get("http_headers")
+        if http_headers:
+            # FFmpeg warns if headers don't end with CRLF
+            args += [
+                "-headers",
+                "".join(
+                    f"{key}: {value}\r\n"
+                    for key, value in http_headers.items()
+                ),
+            ]
+
+    start = (info.get("section_start") or 0) + seek
+    end = info.get("section_end")
+    if start:
+        args += ["-ss", str(start)]
+    if end:
+        args += ["-t", str(end - start)]
+
+    protocol = fmt.get("protocol")
+    if protocol == "rtmp":
+        args += _rtmp_args(fmt)
+    elif protocol == "http_dash_segments" and info.get("is_live"):
+        # FFmpeg may read past the latest segments of live DASH otherwise
+        args += ["-re"]
+
+    args += (
+        (fmt.get("downloader_options") or {}).get("ffmpeg_args")
+        or (info.get("downloader_options") or {}).get("ffmpeg_args")
+        or []
+    )
+    args += ["-i", url]
+
+    env = None
+    if proxy:
+        if not re.match(r"[\da-zA-Z]+://", proxy):
+            proxy = "http://" + proxy
+        env = os.environ.copy()
+        env["HTTP_PROXY"] = env["http_proxy"] = proxy
+    return args, env
+
+
+def loudness_gain(integrated: float, true_peak: float) -> float:
+    """Returns gain in dB that brings measured loudness to the target
+    Quiet songs are made louder only as far as their true peak allows"""
+    gain = TARGET_LOUDNESS - integrated
+    if gain > 0:
+        gain = max(min(gain, TARGET_TRUE_PEAK - true_peak), 0.0)
+    return gain
+
+
+def section_key(song: Song) -> str:
+    "Identifies the played part of the song"
+    key = normalize_url(song.webpage_url)
+    start, end = song.data.get("section_start"), song.data.get("section_end")
+    if start or end:
+        key += f" {start or 0}-{end or ''}"
+    return key
+
+
+def audio_cache_key(song: Song) -> Optional[str]:
+    "Returns key of the song in audio cache, None if it shouldn't be cached"
+    data = song.data
+    duration = song.played_duration
+    if audio_cache is None or not data or data.get("is_live") or not duration:
+        return None
+    if duration * CACHE_BITRATE / 8 > audio_cache.max_bytes / 10:
+        # would evict too many other songs
+        return None
+    return section_key(song)
+
+
+class _FFmpegInput:
+    """Common part of FFmpeg sources that play InputArgs
+    with loudness normalization
+    If gain in dB is known, it's applied instead of the costly loudnorm
+    If cache_key is given, plays the file from audio cache if there is one,
+    otherwise stores the song in the cache when it's played to the end"""
+
+    def __init__(
+        self,
+        input_args: InputArgs,
+        cache_key: Optional[str] = None,
+        seek: float = 0,
+        gain: Optional[float] = None,
+        **kwargs,
+    ):
+        self.input_args, self.input_env = input_args
+        self.cache_key = cache_key
+        self.gain = gain
+        self._cache_temp: Optional[str] = None
+        self._finished = False
+        if cache_key:
+            path = audio_cache.get(cache_key)
+            if path:
+                # the file contains only the played section
+                seek_args = ["-ss", str(seek)] if seek else []
+                self.input_args = [*seek_args, "-i", path]
+                self.input_env = None
+            elif not seek:
+                # only complete songs are stored
+                self._cache_temp = audio_cache.new_file()
+        super().__init__(None, stderr=sys.stderr, **kwargs)
 
+    def _spawn_process(
+        self, args: List[str], **subprocess_kwargs
+    ) -> subprocess.Popen:
+        # replace discord.py's input with ours, keep its output options
+        output_args = args[args.index("-i") + 2 : -1]
+        new_args = [args[0], *self.input_args]
+        if "copy" not in output_args:
+            if self.gain is None:
+                new_args += "-af loudnorm".split()
+            else:
+                new_args += ["-af", f"volume={self.gain:.2f}dB"]
+        new_args += [*output_args, *"-loglevel error".split(), args[-1]]
+        if self._cache_temp:
+            # second output, written at the same time
+            new_args += [*CACHE_OUTPUT_ARGS.split(), "-y", self._cache_temp]
+        subprocess_kwargs["env"] = self.input_env
+        return super()._spawn_process(new_args, **subprocess_kwargs)
 
-class MonkeyPopen:
-    args_catch_lock = threading.Lock()
-    args_catch_future: Optional[Future] = None
+    def read(self) -> bytes:
+        ret = super().read()
+        if not ret:
+            self._finished = True
+        return ret
 
-    def __call__(self, args, *extra, env: Optional[dict] = None, **kwargs):
-        if self.args_catch_lock.locked():
-            self.args_catch_future.set_result((args, env))
-            return _dummy_process
-        return _original_popen(args, *extra, env=env, **kwargs)
+    def cleanup(self) -> None:
+        process = self._process
+        if self._cache_temp and self._finished and process:
+            # let FFmpeg finish writing the file
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                pass
+        super().cleanup()
+        if self._cache_temp:
+            if self._finished and process and process.returncode == 0:
+                audio_cache.add(self.cache_key, self._cache_temp)
+            else:
+                # the song wasn't played to the end
+                audio_cache.discard(self._cache_temp)
+            self._cache_temp = None
 
 
-_downloader_module.Popen = MonkeyPopen()
+@dataclass
+class ReadAheadStats:
+    "Fill levels and underruns of sources that read ahead"
+
+    sources: WeakSet = field(default_factory=WeakSet)
+    # underruns of sources that are closed
+    closed_underruns: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def add(self, source: "_ReadAheadAudio") -> None:
+        with self.lock:
+            self.sources.add(source)
+
+    def remove(self, source: "_ReadAheadAudio") -> None:
+        with self.lock:
+            if source in self.sources:
+                self.sources.discard(source)
+                self.closed_underruns += source.underruns
+
+    def __str__(self) -> str:
+        with self.lock:
+            sources = list(self.sources)
+            underruns = self.closed_underruns
+        underruns += sum(source.underruns for source in sources)
+        fill = (
+            sum(source.fill_level for source in sources) / len(sources)
+            if sources
+            else 0.0
+        )
+        return (
+            f"Read-ahead: {len(sources)} streams,"
+            f" fill avg {fill:.1f}/{config.READ_AHEAD_FRAMES} frames,"
+            f" {underruns} underruns"
+        )
 
 
-def _get_ffmpeg_args(song: Song) -> OriginalArgs:
-    from musicbot.loader import _downloader
+read_ahead_stats = ReadAheadStats()
+
+
+class _ReadAheadAudio(ABC):
+    """Reads frames from FFmpeg in a background thread
+    into a ring of READ_AHEAD_FRAMES slots,
+    so that delays of FFmpeg don't reach the player
+    The frame returned by read() is valid until the next read()"""
+
+    def __init__(self, *args, **kwargs):
+        self._slots: List[Optional[bytes]] = [None] * config.READ_AHEAD_FRAMES
+        # index of the oldest frame in the ring
+        self._head = 0
+        # number of frames in the ring, including the held one
+        self._count = 0
+        # whether the oldest frame was returned by read()
+        self._held = False
+        self._eof = False
+        self._closing = False
+        self._condition = threading.Condition()
+        # how many times the player had to wait for FFmpeg
+        self.underruns = 0
+        self._started = False
+        super().__init__(*args, **kwargs)
+        if self._slots:
+            read_ahead_stats.add(self)
+            threading.Thread(target=self._read_ahead, daemon=True).start()
+
+    @property
+    def fill_level(self) -> int:
+        "Number of frames that are read in advance"
+        return self._count - self._held
+
+    @abstractmethod
+    def _read_frame(self, slot: int) -> Optional[bytes]:
+        "Reads the next frame that will be stored in the slot"
+
+    def _read_ahead(self) -> None:
+        slots = self._slots
+        tail = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._count < len(slots) or self._closing
+                )
+                if self._closing:
+                    return
+            # the slot is free until the frame is counted
+            try:
+                frame = self._read_frame(tail)
+            except Exception:
+                if not self._closing:
+                    print_exc(file=sys.stderr)
+                frame = None
+            with self._condition:
+                if not frame:
+                    self._eof = True
+                    self._condition.notify_all()
+                    return
+                slots[tail] = frame
+                self._count += 1
+                self._condition.notify_all()
+            tail = (tail + 1) % len(slots)
 
-    with MonkeyPopen.args_catch_lock:
-        try:
-            MonkeyPopen.args_catch_future = Future()
-            _downloader.download("-", song.data)
-            return MonkeyPopen.args_catch_future.result()
-        finally:
-            MonkeyPopen.args_catch_future = None
+    def read(self) -> bytes:
+        if not self._slots:
+            frame = self._read_frame(0)
+            if not frame:
+                self._check_process_returncode()
+                return b""
+            return frame
+        with self._condition:
+            if self._held:
+                # the caller is done with the previous frame
+                self._head = (self._head + 1) % len(self._slots)
+                self._count -= 1
+                self._held = False
+                self._condition.notify_all()
+            if not self._count and not self._eof:
+                if self._started:
+                    self.underruns += 1
+                self._condition.wait_for(lambda: self._count or self._eof)
+            if not self._count:
+                # same as discord.py does at the end
+                self._check_process_returncode()
+                return b""
+            self._held = True
+            self._started = True
+            return self._slots[self._head]
 
+    def cleanup(self) -> None:
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        read_ahead_stats.remove(self)
+        super().cleanup()
 
-class FFmpegPCMAudio(BasePCMAudio):
-    def __init__(self, original_args: OriginalArgs):
-        self.original_args, self.original_env = original_args
-        super().__init__(None, stderr=sys.stderr)
 
-    def _spawn_process(
-        self, args: List[str], **subprocess_kwargs
-    ) -> subprocess.Popen:
-        new_args = self.original_args.copy()
-        new_args[1:1] = (
-            "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5".split()
+class _ReadAheadPCMAudio(_ReadAheadAudio, BasePCMAudio):
+    "Reads PCM with readinto into buffers that are allocated once"
+
+    def __init__(self, *args, **kwargs):
+        self._buffers = [
+            memoryview(bytearray(OpusEncoder.FRAME_SIZE))
+            # one buffer is needed when reading without read-ahead
+            for _ in range(max(config.READ_AHEAD_FRAMES, 1))
+        ]
+        super().__init__(*args, **kwargs)
+
+    def _read_frame(self, slot: int) -> Optional[memoryview]:
+        view = self._buffers[slot]
+        size = 0
+        while size < len(view):
+            read = self._stdout.readinto(view[size:])
+            if not read:
+                return None
+            size += read
+        return view
+
+
+class _ReadAheadOpusAudio(_ReadAheadAudio, BaseOpusAudio):
+    "Reads Ogg pages and stores the Opus packets from them"
+
+    def _read_frame(self, slot: int) -> Optional[bytes]:
+        for packet in self._packet_iter:
+            # the decoder would fail on headers
+            if not packet.startswith(OPUS_HEADERS):
+                return packet
+        return None
+
+
+class FFmpegPCMAudio(_FFmpegInput, _ReadAheadPCMAudio):
+    pass
+
+
+class FFmpegOpusAudio(_FFmpegInput, _ReadAheadOpusAudio):
+    """Lets FFmpeg encode the input to Opus
+    With copy=True, the input must be Opus already
+    and is sent without re-encoding and normalization"""
+
+    def __init__(
+        self,
+        input_args: InputArgs,
+        cache_key: Optional[str] = None,
+        seek: float = 0,
+        gain: Optional[float] = None,
+        copy: bool = False,
+    ):
+        super().__init__(
+            input_args,
+            cache_key,
+            seek,
+            gain,
+            codec="opus" if copy else None,
         )
-        try:
-            c_index = new_args.index("-c")
-            del new_args[c_index : c_index + 2]
-        except ValueError:
-            pass
-        f_index = new_args.index("-f")
-        new_args[f_index : f_index + 2] = (
-            "-af loudnorm".split()
-            + args[args.index("-f") : -1]
-            + "-loglevel error".split()
+
+
+def decode_ogg_opus(path: str) -> bytes:
+    "Decodes Ogg Opus file to PCM without FFmpeg"
+    decoder = OpusDecoder()
+    with open(path, "rb") as f:
+        return b"".join(
+            decoder.decode(packet)
+            for packet in OggStream(f).iter_packets()
+            # skip headers
+            if not packet.startswith(OPUS_HEADERS)
         )
-        subprocess_kwargs["env"] = self.original_env
-        return super()._spawn_process(new_args, **subprocess_kwargs)
+
+
+class MemoryAudio(AudioSource):
+    "Plays PCM from memory, the data is not copied"
+
+    def __init__(self, pcm: bytes):
+        self.pcm = memoryview(pcm)
+        self.offset = 0
+
+    def read(self) -> bytes:
+        frame = self.pcm[self.offset : self.offset + OpusEncoder.FRAME_SIZE]
+        self.offset += OpusEncoder.FRAME_SIZE
+        if not frame:
+            return b""
+        return bytes(frame).ljust(OpusEncoder.FRAME_SIZE, b"\0")
+
+
+class ReleasedAudio(AudioSource):
+    "Stands in for the source of a paused stream that was closed"
+
+    def read(self) -> bytes:
+        return b""
+
+
+class AudioPrebuffer(AudioSource):
+    "Holds frames of the source that were read in advance"
+
+    def __init__(self, source: AudioSource):
+        self.source = source
+        self.frames: deque[bytes] = deque()
+
+    def fill(self, frame_count: int) -> None:
+        "Blocks until frame_count frames are read or the source ends"
+        while len(self.frames) < frame_count:
+            frame = self.source.read()
+            if not frame:
+                break
+            # the source may reuse the buffer of the frame
+            self.frames.append(bytes(frame))
+
+    def read(self) -> bytes:
+        if self.frames:
+            return self.frames.popleft()
+        return self.source.read()
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def cleanup(self) -> None:
+        self.frames.clear()
+        self.source.cleanup()
 
 
 @dataclass
 class AudioStream:
     source: AudioSource
     after: Optional[Callable[[], None]] = None
+    # called when the stream replaces a finished one
+    before: Optional[Callable[[], None]] = None
     paused: bool = False
     rewindable: bool = False
+    volume: float = 1.0
+    # number of frames read from the source
+    frames: int = 0
+    # position of the first frame in seconds
+    start: float = 0.0
+    # decodes Opus frames when they need to be mixed
+    decoder: Optional[OpusDecoder] = None
+
+    @property
+    def position(self) -> float:
+        "Current playback position in seconds"
+        return self.start + self.frames * OpusEncoder.FRAME_LENGTH / 1000
+
+    def pcm(self, frame: bytes) -> bytes:
+        "Converts the frame read from the source to PCM"
+        if self.source.is_opus():
+            if self.decoder is None:
+                self.decoder = OpusDecoder()
+            frame = self.decoder.decode(frame)[: OpusEncoder.FRAME_SIZE]
+            frame = frame.ljust(OpusEncoder.FRAME_SIZE, b"\0")
+        return frame
 
 
 class AudioMixer(AudioSource):
     SILENCE = b"\0" * OpusEncoder.FRAME_SIZE
+    # samples above this part of full scale are compressed
+    LIMIT_THRESHOLD = 0.9
     FRAMES_PER_SECOND = round(1000 / OpusEncoder.FRAME_LENGTH)
     MAX_REWIND_FRAMES = FRAMES_PER_SECOND * config.MAX_REWIND_SECONDS
+    MAX_PCM_REWIND_FRAMES = FRAMES_PER_SECOND * min(
+        config.MAX_PCM_REWIND_SECONDS, config.MAX_REWIND_SECONDS
+    )
 
     def __init__(self, client: VoiceClient):
         self.client = client
         self.streams: Dict[int, AudioStream] = {}
-        self.rewinds: defaultdict[int, deque[bytes]] = defaultdict(
-            lambda: deque(maxlen=self.MAX_REWIND_FRAMES)
+        # streams that start when the stream with the same id ends
+        self.pending: Dict[int, AudioStream] = {}
+        self.rewinds: defaultdict[int, RewindBuffer] = defaultdict(
+            lambda: RewindBuffer(
+                self.MAX_REWIND_FRAMES, self.MAX_PCM_REWIND_FRAMES
+            )
         )
         self._stop_future = Future()
         self._stop_future.cancel()
+        # whether the last frame returned by read() is Opus-encoded
+        self._opus = False
+        # whether the player is paused because nothing is audible
+        self._suspended = False
+        self._suspend_lock = threading.Lock()
+        # buffers reused by read()
+        samples = OpusEncoder.FRAME_SIZE // 2
+        self._mix = np.empty(samples, np.float32)
+        self._scaled = np.empty(samples, np.float32)
+        self._output = np.empty(samples, np.int16)
 
     def read(self) -> bytes:
-        return reduce(
-            lambda a, b: audioop.add(a, b, 2),
-            self._read_streams(),
-            self.SILENCE,
+        frames = list(self._read_streams())
+        if len(frames) == 1:
+            stream, frame = frames[0]
+            if stream.source.is_opus() and stream.volume == 1.0:
+                # nothing to mix, send the frame as is
+                stream.decoder = None
+                self._opus = True
+                return frame
+        self._opus = False
+        if not frames:
+            self._suspend()
+            return self.SILENCE
+
+        mix = self._mix
+        mix.fill(0.0)
+        for stream, frame in frames:
+            samples = np.frombuffer(stream.pcm(frame), np.int16)
+            np.multiply(
+                samples, min(stream.volume, 2.0) / 32768, out=self._scaled
+            )
+            mix += self._scaled
+        self._limit(mix)
+        mix *= 32767
+        np.copyto(self._output, mix, casting="unsafe")
+        return self._output.tobytes()
+
+    def _limit(self, mix: np.ndarray) -> None:
+        "Smoothly compresses samples above LIMIT_THRESHOLD to fit into 1.0"
+        threshold = self.LIMIT_THRESHOLD
+        levels = np.abs(mix, out=self._scaled)
+        if levels.max() <= threshold:
+            # the usual case, don't allocate anything
+            return
+        loud = levels > threshold
+        headroom = 1.0 - threshold
+        mix[loud] = np.sign(mix[loud]) * (
+            threshold
+            + headroom * np.tanh((levels[loud] - threshold) / headroom)
         )
 
-    def _read_streams(self) -> Iterable[AudioStream]:
+    def _suspend(self) -> None:
+        "Pauses the player until something audible is added"
+        with self._suspend_lock:
+            if self._suspended or any(
+                not stream.paused for stream in self.streams.values()
+            ):
+                return
+            self._suspended = True
+            if audio_scheduler:
+                audio_scheduler.pause(self)
+            else:
+                self.client.pause()
+
+    def _resume(self) -> None:
+        with self._suspend_lock:
+            if not self._suspended:
+                return
+            self._suspended = False
+            if audio_scheduler:
+                audio_scheduler.resume(self)
+            else:
+                self.client.resume()
+
+    def is_opus(self) -> bool:
+        # discord.py checks this after every read
+        return self._opus
+
+    def _read_streams(self) -> Iterable[Tuple[AudioStream, bytes]]:
         for id_ in tuple(self.streams):
             stream = self.streams[id_]
             if stream.paused:
                 continue
 
-            ret = stream.source.read()
+            source = stream.source
+            ret = source.read()
+            if not ret and stream.source is not source:
+                # replaced while reading, the old source is closed
+                continue
+            if not ret and not isinstance(source, AudioRewind):
+                next_stream = self.pending.pop(id_, None)
+                if next_stream:
+                    # switch in the same frame, without calling after
+                    stream.source.cleanup()
+                    stream = self.streams[id_] = next_stream
+                    # rewinding shouldn't reach the previous song
+                    self.rewinds[id_].clear()
+                    self._call(stream.before)
+                    ret = stream.source.read()
             if not ret:
                 self._stop_stream_once(id_)
                 continue
 
+            stream.frames += 1
             if stream.rewindable:
-                self.rewinds[id_].append(ret)
+                self.rewinds[id_].append(ret, stream.source.is_opus())
 
-            yield ret
+            yield stream, ret
 
     def cleanup(self) -> None:
         for id_ in tuple(self.streams):
             self.stop_stream(id_)
+        self._opus = False
+        # the player is stopped, there is nothing to resume
+        with self._suspend_lock:
+            self._suspended = False
 
     def add_stream(
         self,
@@ -138,26 +699,123 @@ class AudioMixer(AudioSource):
         id_: Optional[int] = None,
         after: Optional[Callable[[], None]] = None,
         rewindable: bool = False,
+        volume: float = 1.0,
     ) -> None:
-        if source.is_opus():
-            raise ValueError("source must not be Opus-encoded")
+        self._add_stream(
+            id_,
+            AudioStream(
+                source, after=after, rewindable=rewindable, volume=volume
+            ),
+        )
 
+    def _add_stream(self, id_: Optional[int], stream: AudioStream) -> None:
         if id_ is None:
             id_ = max(self.streams, default=0) + 1
         elif id_ in self.streams:
             raise ValueError(f"stream with id {id_} already exists")
-        self.streams[id_] = AudioStream(
-            source, after=after, rewindable=rewindable
-        )
+        self.streams[id_] = stream
 
         self._stop_future.cancel()
-        if not self.client.is_playing():
-            self.client.play(self)
+        if not self.is_playing():
+            with self._suspend_lock:
+                # the player may be stopped while suspended
+                self._suspended = False
+            if audio_scheduler:
+                audio_scheduler.play(self, self.client)
+            else:
+                self.client.play(self)
+        else:
+            self._resume()
+
+    def queue_stream(
+        self,
+        source: AudioSource,
+        *,
+        id_: int,
+        after: Optional[Callable[[], None]] = None,
+        before: Optional[Callable[[], None]] = None,
+        rewindable: bool = False,
+        volume: float = 1.0,
+    ) -> bool:
+        """Plays the source right after the stream with the same id ends
+        Returns False if there is no such stream"""
+        if id_ not in self.streams:
+            return False
+        self.unqueue_stream(id_)
+        self.pending[id_] = AudioStream(
+            source,
+            after=after,
+            before=before,
+            rewindable=rewindable,
+            volume=volume,
+        )
+        return True
+
+    def unqueue_stream(self, id_: int) -> None:
+        stream = self.pending.pop(id_, None)
+        if stream:
+            stream.source.cleanup()
+
+    def is_playing(self) -> bool:
+        "Whether the player runs, it may be suspended"
+        if audio_scheduler:
+            return audio_scheduler.is_playing(self)
+        return self.client.is_playing() or self.client.is_paused()
+
+    def stop(self) -> None:
+        "Stops playing, all streams are stopped too"
+        if audio_scheduler:
+            audio_scheduler.stop(self)
+        else:
+            self.client.stop()
+
+    def pause_stream(self, id_: int) -> None:
+        stream = self.streams.get(id_)
+        if stream:
+            stream.paused = True
+
+    def resume_stream(self, id_: int) -> None:
+        stream = self.streams.get(id_)
+        if stream:
+            stream.paused = False
+            self._resume()
 
     def get_stream(self, id_: int) -> Optional[AudioStream]:
         return self.streams.get(id_)
 
+    def get_pending(self, id_: int) -> Optional[AudioStream]:
+        return self.pending.get(id_)
+
+    def get_position(self, id_: int) -> Optional[float]:
+        stream = self.streams.get(id_)
+        return stream and stream.position
+
+    def replace_source(
+        self, id_: int, source: AudioSource, position: float
+    ) -> bool:
+        """Continues the stream with another source,
+        which starts at position seconds
+        Returns False if there is no such stream"""
+        stream = self.streams.get(id_)
+        if stream and isinstance(stream.source, AudioRewind):
+            # stop the rewind, the position is changed anyway
+            self._stop_stream_once(id_)
+            stream = self.streams.get(id_)
+        if not stream:
+            return False
+
+        old_source = stream.source
+        stream.source = source
+        stream.frames = 0
+        stream.start = position
+        stream.decoder = None
+        old_source.cleanup()
+        # the history doesn't lead to the new position
+        self.rewinds[id_].clear()
+        return True
+
     def stop_stream(self, id_: int) -> None:
+        self.unqueue_stream(id_)
         stream = self.streams.get(id_)
         if stream and isinstance(stream.source, AudioRewind):
             # stop the rewind
@@ -167,25 +825,31 @@ class AudioMixer(AudioSource):
 
     def _stop_stream_once(self, id_: int) -> None:
         stream = self.streams.pop(id_, None)
-        if stream and stream.after:
-            try:
-                stream.after()
-            except Exception:
-                print_exc(file=sys.stderr)
+        if stream:
+            stream.source.cleanup()
+            self._call(stream.after)
 
-        if not self.streams and self.client.is_playing():
+        if not self.streams and self.is_playing():
             self._stop_future.cancel()
 
             def stop():
                 time.sleep(3)
                 if not future.set_running_or_notify_cancel():
                     return
-                self.client.stop()
+                self.stop()
                 future.set_result(None)
 
             future = self._stop_future = Future()
             threading.Thread(target=stop, daemon=True).start()
 
+    @staticmethod
+    def _call(callback: Optional[Callable[[], None]]) -> None:
+        if callback:
+            try:
+                callback()
+            except Exception:
+                print_exc(file=sys.stderr)
+
     def fast_forward_stream(self, id_: int, frame_count: int) -> None:
         stream = self.streams.get(id_)
         if not stream:
@@ -195,7 +859,9 @@ class AudioMixer(AudioSource):
         for _ in range(frame_count):
             if not stream.paused or not stream.source.read():
                 break
+            stream.frames += 1
         stream.paused = False
+        self._resume()
 
     def rewind_stream(self, id_: int, frame_count: int) -> int:
         current_stream = self.streams.get(id_)
@@ -207,21 +873,119 @@ class AudioMixer(AudioSource):
 
         def restore():
             if current_stream:
+                # volume may be changed during the rewind
+                current_stream.volume = rewind_stream.volume
                 self.streams[id_] = current_stream
 
-        frames = tuple(self.rewinds[id_])[-frame_count:]
-        self.add_stream(
-            AudioRewind(frames),
-            id_=id_,
+        history = self.rewinds[id_]
+        frames = history.get(frame_count)
+        rewind_stream = AudioStream(
+            AudioRewind(frames, opus=history.opus),
             after=restore,
+            volume=current_stream.volume if current_stream else 1.0,
+            start=(
+                max(
+                    current_stream.position
+                    - len(frames) * OpusEncoder.FRAME_LENGTH / 1000,
+                    0.0,
+                )
+                if current_stream
+                else 0.0
+            ),
         )
+        self._add_stream(id_, rewind_stream)
 
         return len(frames)
 
 
+class RewindBuffer:
+    """Stores the last frames of a stream in a ring
+    that grows as frames arrive, up to max_frames Opus packets
+    or max_pcm_frames PCM frames
+    Opus packets take much less space than PCM frames,
+    PCM frames are stored as they are to keep the player thread fast
+    If packets are bigger than FRAME_BYTES on average,
+    fewer than max_frames are kept"""
+
+    # enough for 160 kbps, the usual bitrate of Opus on YouTube
+    FRAME_BYTES = 400
+
+    def __init__(self, max_frames: int, max_pcm_frames: int):
+        self.max_frames = max_frames
+        self.max_pcm_frames = max_pcm_frames
+        self._data = bytearray()
+        # (offset, size) of stored packets, the oldest first
+        self._frames: deque[Tuple[int, int]] = deque(maxlen=max_frames)
+        self._end = 0
+        # whether the stored frames are Opus packets
+        self.opus = True
+        # frames are appended by the player thread
+        self._lock = threading.Lock()
+
+    def _capacity(self) -> int:
+        if self.opus:
+            return self.max_frames * self.FRAME_BYTES
+        return self.max_pcm_frames * OpusEncoder.FRAME_SIZE
+
+    def append(self, frame: bytes, opus: bool) -> None:
+        size = len(frame)
+        with self._lock:
+            if opus != self.opus:
+                # frames of different types can't be replayed together,
+                # the allocated memory is reused for new ones
+                self._frames.clear()
+                self._end = 0
+                self.opus = opus
+            capacity = self._capacity()
+            if not size or size > max(capacity, len(self._data)):
+                return
+            frames = self._frames
+            if self._end + size > len(self._data):
+                # packets after the end are the oldest ones
+                wrapped = frames and frames[0][0] >= self._end
+                if not wrapped and len(self._data) < capacity:
+                    new_size = min(
+                        max(len(self._data) * 2, self._end + size), capacity
+                    )
+                    self._data += bytes(new_size - len(self._data))
+            if self._end + size > len(self._data):
+                while frames and frames[0][0] >= self._end:
+                    frames.popleft()
+                self._end = 0
+            start, end = self._end, self._end + size
+            # drop packets that will be overwritten
+            while frames and frames[0][0] < end and sum(frames[0]) > start:
+                frames.popleft()
+            self._data[start:end] = frame
+            frames.append((start, size))
+            self._end = end
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._frames.clear()
+            self._end = 0
+
+    def get(self, frame_count: int) -> List[bytes]:
+        "Returns up to frame_count last packets"
+        if frame_count <= 0:
+            return []
+        with self._lock:
+            return [
+                bytes(self._data[offset : offset + size])
+                for offset, size in tuple(self._frames)[-frame_count:]
+            ]
+
+
 class AudioRewind(AudioSource):
-    def __init__(self, frames: Iterable[bytes]):
+    def __init__(self, frames: Iterable[bytes], opus: bool = False):
         self.frames = iter(frames)
+        self.opus = opus
+
+    def is_opus(self) -> bool:
+        return self.opus
 
     def read(self) -> bytes:
         try:
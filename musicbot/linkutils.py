@@ -2,10 +2,12 @@ import re
 import sys
 import asyncio
 from enum import Enum, auto
+from functools import lru_cache
+from collections import defaultdict
 from traceback import print_exc
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlencode, parse_qsl
 from multiprocessing import current_process
-from typing import Optional, Union, List
+from typing import Dict, FrozenSet, Optional, Union, List
 
 from spotipy import Spotify
 from bs4 import BeautifulSoup
@@ -18,6 +20,11 @@ from yt_dlp.extractor.lazy_extractors import LazyLoadExtractor
 from config import config
 from musicbot import loader
 
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
 spotify_api = None
 if config.SPOTIFY_ID or config.SPOTIFY_SECRET:
     try:
@@ -58,6 +65,11 @@ spotify_regex = re.compile(
     r"(?P<type>track|playlist|album)/(?P<code>\w+)"
 )
 
+# query parameters that don't affect the content
+TRACKING_PARAMS = frozenset(
+    ("si", "feature", "pp", "fbclid", "gclid", "igshid", "ab_channel")
+)
+
 headers = {}
 
 _session = None
@@ -95,14 +107,19 @@ async def get_soup(url: str) -> BeautifulSoup:
     return BeautifulSoup(page, "html.parser")
 
 
-async def fetch_spotify(url: str) -> Optional[Union[dict, List[str]]]:
-    """Searches YouTube for Spotify song or loads Spotify playlist"""
+async def fetch_spotify(
+    url: str, items: Optional[slice] = None
+) -> Optional[Union[dict, List[dict]]]:
+    """Searches YouTube for Spotify song or loads Spotify playlist
+    If items is given, loads only that part of playlist"""
     match = spotify_regex.match(url)
     # strip any extra parts
     url = match.group()
     url_type = match.group("type")
     if url_type != "track":
-        return await fetch_spotify_playlist(url, url_type, match.group("code"))
+        return await fetch_spotify_playlist(
+            url, url_type, match.group("code"), items
+        )
 
     soup = await get_soup(url)
 
@@ -116,33 +133,43 @@ async def fetch_spotify(url: str) -> Optional[Union[dict, List[str]]]:
 
 
 async def fetch_spotify_playlist(
-    url: str, list_type: str, code: str
-) -> List[str]:
-    """Returns list of Spotify links"""
+    url: str, list_type: str, code: str, items: Optional[slice] = None
+) -> List[dict]:
+    """Returns list of Spotify links with available metadata"""
 
     if spotify_api:
-        return fetch_playlist_with_api(SpotifyPlaylistTypes(list_type), code)
+        return fetch_playlist_with_api(
+            SpotifyPlaylistTypes(list_type), code, items
+        )
 
     soup = await get_soup(url)
     results = soup.find_all(attrs={"name": "music:song", "content": True})
+    if items is not None:
+        results = results[items]
 
-    return [item["content"] for item in results]
+    return [{"url": item["content"]} for item in results]
 
 
 def fetch_playlist_with_api(
-    list_type: SpotifyPlaylistTypes, code: str
-) -> List[str]:
+    list_type: SpotifyPlaylistTypes, code: str, items: Optional[slice] = None
+) -> List[dict]:
+    offset = 0
+    limit = None
+    if items is not None:
+        offset = items.start
+        limit = items.stop - items.start
     tracks = []
     try:
         if list_type == SpotifyPlaylistTypes.ALBUM:
-            results = spotify_api.album_tracks(code)
+            results = spotify_api.album_tracks(code, offset=offset)
         elif list_type == SpotifyPlaylistTypes.PLAYLIST:
-            results = spotify_api.playlist_items(code)
+            results = spotify_api.playlist_items(code, offset=offset)
 
         if results:
-            while results:
+            while results and (limit is None or len(tracks) < limit):
                 tracks.extend(results["items"])
                 results = spotify_api.next(results)
+            tracks = tracks[:limit]
         else:
             print(
                 f"Warning: Spotify API returned nothing"
@@ -156,30 +183,199 @@ def fetch_playlist_with_api(
         )
         print_exc(file=sys.stderr)
 
-    links = []
-    for track in tracks:
+    entries = []
+    for item in tracks:
+        track = item.get("track", item)
         try:
-            links.append(track.get("track", track)["external_urls"]["spotify"])
+            entry = {"url": track["external_urls"]["spotify"]}
         except KeyError as e:
             print(
-                f"Warning: Cannot extract URL from {track}:"
+                f"Warning: Cannot extract URL from {item}:"
                 f" field {e.args[0]!r} is missing",
                 file=sys.stderr,
             )
-    return links
+            continue
+        # this metadata allows to skip fetching the page of each track
+        if track.get("name"):
+            entry["title"] = track["name"]
+        artists = ", ".join(a["name"] for a in track.get("artists", ()))
+        if artists:
+            entry["uploader"] = artists
+        if track.get("duration_ms"):
+            entry["duration"] = track["duration_ms"] // 1000
+        entries.append(entry)
+    return entries
+
+
+def get_spotify_track_id(url: str) -> Optional[str]:
+    match = spotify_regex.match(url)
+    if match and match.group("type") == "track":
+        return match.group("code")
+    return None
 
 
 def get_urls(content: str) -> List[str]:
     return [m[0] for m in url_regex.findall(content)]
 
 
-def get_ie(url: str) -> Optional[ExtractorT]:
+def normalize_url(url: str) -> str:
+    """Strips tracking parameters and other noise from URL
+    so that equal resources have equal URLs"""
+    parsed = urlparse(url)
+    netloc = parsed.netloc.lower()
+    if netloc.startswith("www."):
+        netloc = netloc[4:]
+    query = sorted(
+        (k, v)
+        for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+        if k not in TRACKING_PARAMS and not k.startswith("utm_")
+    )
+    return parsed._replace(
+        scheme=parsed.scheme.lower(),
+        netloc=netloc,
+        query=urlencode(query),
+        fragment="",
+    ).geturl()
+
+
+# extractor index keys are parts of words from _VALID_URL
+MIN_KEY_LENGTH = 3
+MAX_KEY_LENGTH = 12
+_word_regex = re.compile(r"[a-z0-9]+")
+_DEFAULT_SUITABLE = (
+    InfoExtractor.suitable.__func__,
+    LazyLoadExtractor.suitable.__func__,
+)
+_REPEATS = tuple(
+    getattr(sre_parse, name)
+    for name in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT")
+    if hasattr(sre_parse, name)
+)
+# word -> positions of extractors in EXTRACTORS
+_ie_index: Optional[Dict[str, List[int]]] = None
+# positions of extractors that can't be indexed
+_unindexed_ies: List[int] = []
+
+
+def _longest_word(literal: str) -> str:
+    return max(_word_regex.findall(literal), key=len, default="")
+
+
+def _literals_score(literals: FrozenSet[str]) -> int:
+    return min(len(_longest_word(literal)) for literal in literals)
+
+
+def _required_literals(items) -> Optional[FrozenSet[str]]:
+    """Returns strings one of which is present in any match
+    of the parsed pattern, lowercased
+    None means there are no such strings suitable for indexing"""
+    best = None
+    best_score = MIN_KEY_LENGTH - 1
+    run = ""
+    # sentinel item ends the last literal run
+    for op, av in [*items, (None, None)]:
+        if op == sre_parse.LITERAL:
+            run += chr(av).lower()
+            continue
+        candidates = []
+        if run:
+            candidates.append(frozenset((run,)))
+            run = ""
+        if op == sre_parse.SUBPATTERN:
+            candidates.append(_required_literals(av[-1]))
+        elif op in _REPEATS and av[0] >= 1:
+            candidates.append(_required_literals(av[2]))
+        elif op == sre_parse.BRANCH:
+            branches = [_required_literals(branch) for branch in av[1]]
+            if all(branches):
+                candidates.append(frozenset().union(*branches))
+        for literals in candidates:
+            if literals and _literals_score(literals) > best_score:
+                best = literals
+                best_score = _literals_score(literals)
+    return best
+
+
+def _extractor_literals(ie: ExtractorT) -> Optional[FrozenSet[str]]:
+    if getattr(ie.suitable, "__func__", None) not in _DEFAULT_SUITABLE:
+        # custom logic, can't be indexed
+        return None
+    if ie._VALID_URL is False:
+        # never suitable
+        return frozenset()
+    patterns = ie._VALID_URL
+    if isinstance(patterns, str):
+        patterns = (patterns,)
+    result = frozenset()
+    for pattern in patterns:
+        literals = _required_literals(sre_parse.parse(pattern))
+        if literals is None:
+            return None
+        result |= literals
+    return result
+
+
+def _build_ie_index():
+    global _ie_index
+    index = defaultdict(list)
+    for position, ie in enumerate(EXTRACTORS):
+        if ie is GENERIC_IE:
+            continue
+        try:
+            literals = _extractor_literals(ie)
+        except Exception:
+            literals = None
+        if literals is None:
+            _unindexed_ies.append(position)
+            continue
+        for literal in literals:
+            key = _longest_word(literal)[:MAX_KEY_LENGTH]
+            index[key].append(position)
+    _ie_index = dict(index)
+
+
+def _scan_extractors(url: str) -> Optional[ExtractorT]:
     for ie in EXTRACTORS:
         if ie.suitable(url) and ie is not GENERIC_IE:
             return ie
     return None
 
 
+def _lookup_extractor(url: str) -> Optional[ExtractorT]:
+    """Same as _scan_extractors, but only checks extractors
+    whose _VALID_URL has a word that is present in the URL"""
+    if _ie_index is None:
+        try:
+            _build_ie_index()
+        except Exception:
+            print_exc(file=sys.stderr)
+            print("Failed to index extractors.", file=sys.stderr)
+    if not _ie_index:
+        return _scan_extractors(url)
+
+    positions = set(_unindexed_ies)
+    for token in _word_regex.findall(url.lower()):
+        # keys may be parts of words in the URL
+        for start in range(len(token) - MIN_KEY_LENGTH + 1):
+            for end in range(
+                start + MIN_KEY_LENGTH,
+                min(start + MAX_KEY_LENGTH, len(token)) + 1,
+            ):
+                positions.update(_ie_index.get(token[start:end], ()))
+    # keep the original priority
+    for position in sorted(positions):
+        ie = EXTRACTORS[position]
+        if ie.suitable(url):
+            return ie
+    return None
+
+
+@lru_cache(maxsize=4096)
+def get_ie(url: str) -> Optional[ExtractorT]:
+    return _lookup_extractor(url)
+
+
+@lru_cache(maxsize=4096)
 def identify_url(url: str) -> Union[SiteTypes, ExtractorT]:
     if not url_regex.fullmatch(url):
         return SiteTypes.NOT_URL
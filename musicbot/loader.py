@@ -1,30 +1,56 @@
 import sys
 import json
+import time
+import math
+import threading
 import atexit
 import asyncio
-import threading
+import subprocess
 from inspect import getmodule
+from traceback import print_exc
+from dataclasses import dataclass
 from urllib.parse import urlparse, parse_qs
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from concurrent.futures import ProcessPoolExecutor
 from multiprocessing import get_context as mp_context
-from typing import List, Optional, Union
+from multiprocessing.managers import AcquirerProxy, BaseManager
+from typing import (
+    AsyncIterator,
+    Container,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 from aiohttp import ClientResponseError
 from yt_dlp import YoutubeDL, DownloadError
 
 from config import config
 from musicbot.bot import MusicBot
+from musicbot.settings import SpotifyMatch
 from musicbot.song import Song, SongError
+from musicbot.cache import ExtractionCache, SearchCache
 from musicbot.utils import OutputWrapper
-from musicbot.ffmpeg import OriginalArgs, _get_ffmpeg_args, downloader_class
+from musicbot.ffmpeg import (
+    InputArgs,
+    audio_cache,
+    build_input_args,
+    loudness_gain,
+    section_key,
+)
 from musicbot.linkutils import (
     GENERIC_IE,
     ExtractorT,
     SiteTypes,
     get_ie,
+    url_regex,
     fetch_spotify,
     identify_url,
+    get_spotify_track_id,
+    normalize_url,
     init as init_session,
     stop as stop_session,
 )
@@ -33,6 +59,9 @@ sys.stdout = OutputWrapper(sys.stdout)
 sys.stderr = OutputWrapper(sys.stderr)
 
 _context = mp_context("spawn")
+# size of the first part of playlist loaded by load_song_batches
+PLAYLIST_BATCH_SIZE = 100
+YOUTUBE_VIDEO_URL = "https://www.youtube.com/watch?v="
 
 
 class LoaderProcess(_context.Process):
@@ -58,7 +87,50 @@ _loop = asyncio.new_event_loop()
 _loop.run_until_complete(init_session())
 atexit.register(lambda: _loop.run_until_complete(stop_session()))
 atexit.register(lambda: _loop.run_until_complete(close_bot_session()))
-_executor = ProcessPoolExecutor(1, _context)
+# semaphores of the manager process, by site
+_manager_semaphores: Dict[str, threading.BoundedSemaphore] = {}
+_manager_lock = threading.Lock()
+
+
+def _get_site_semaphore(site: str, limit: int) -> threading.BoundedSemaphore:
+    "Runs in the manager process, creates the semaphore on first use"
+    with _manager_lock:
+        if site not in _manager_semaphores:
+            _manager_semaphores[site] = threading.BoundedSemaphore(limit)
+        return _manager_semaphores[site]
+
+
+class SiteManager(BaseManager):
+    "Holds per-site semaphores shared by all loader processes"
+
+
+SiteManager.register(
+    "site_semaphore", _get_site_semaphore, proxytype=AcquirerProxy
+)
+
+# started in init(), workers connect to it in _init_worker
+_site_manager: Optional[SiteManager] = None
+# proxies of semaphores used by this process, by site
+_site_semaphores: Dict[str, AcquirerProxy] = {}
+# created in init()
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def _init_worker(manager_address):
+    global _site_manager
+    _site_manager = SiteManager(manager_address)
+    _site_manager.connect()
+
+
+def _site_semaphore(site: str) -> AcquirerProxy:
+    semaphore = _site_semaphores.get(site)
+    if semaphore is None:
+        semaphore = _site_semaphores[site] = _site_manager.site_semaphore(
+            site, config.MAX_SITE_CONCURRENCY
+        )
+    return semaphore
+
+
 _extractor = YoutubeDL(
     {
         "format": "bestaudio/best",
@@ -74,9 +146,50 @@ _extractor = YoutubeDL(
         "proxy": config.PROXY_URL,
     }
 )
-_downloader = downloader_class(_extractor, _extractor.params)
+_cache = (
+    ExtractionCache(config.EXTRACTION_CACHE_PATH)
+    if config.EXTRACTION_CACHE_PATH
+    else None
+)
+_spotify_semaphore = asyncio.Semaphore(config.SPOTIFY_RESOLVE_CONCURRENCY)
+search_cache = SearchCache(config.SEARCH_CACHE_SIZE, config.SEARCH_CACHE_TTL)
 _preloading = {}
-_site_locks = {}
+# loudness analyses in progress by section key
+_analyzing: Dict[str, asyncio.Task] = {}
+_analysis_semaphore = asyncio.Semaphore(config.LOUDNESS_ANALYSIS_CONCURRENCY)
+# normalized URL, playlist items and whether cached info is ignored
+_LoadKey = Tuple[str, Optional[Tuple[int, int]], bool]
+# loads that are in progress
+_loading: Dict[_LoadKey, asyncio.Future] = {}
+
+
+@dataclass
+class LoaderStats:
+    submitted: int = 0
+    completed: int = 0
+    waited: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+    @property
+    def pending(self) -> int:
+        return self.submitted - self.completed
+
+    def add_wait(self, wait: float):
+        self.waited += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def __str__(self) -> str:
+        average = self.total_wait / self.waited if self.waited else 0.0
+        return (
+            f"Loader: {config.LOADER_WORKERS} workers,"
+            f" {self.pending} pending, {self.completed} completed,"
+            f" wait avg {average:.3f}s max {self.max_wait:.3f}s"
+        )
+
+
+stats = LoaderStats()
 
 
 def _noop():
@@ -84,29 +197,77 @@ def _noop():
 
 
 def init():
-    # wake it up to spawn the process immediately
-    _executor.submit(_noop).result()
-
-
-def _extract_info(url: str, ie: Optional[ExtractorT] = None) -> Optional[dict]:
+    global _site_manager, _executor
+    _site_manager = SiteManager(ctx=_context)
+    _site_manager.start()
+    _executor = ProcessPoolExecutor(
+        config.LOADER_WORKERS,
+        _context,
+        initializer=_init_worker,
+        initargs=(_site_manager.address,),
+    )
+    # wake it up to spawn the processes immediately
+    for future in [
+        _executor.submit(_noop) for _ in range(config.LOADER_WORKERS)
+    ]:
+        future.result()
+
+
+def _extract_info(
+    url: str,
+    ie: Optional[ExtractorT] = None,
+    items: Optional[slice] = None,
+    refresh: bool = False,
+) -> Optional[dict]:
     if ie is None:
         ie = get_ie(url)
-    # cache by module (effectively means by site)
+    # yt-dlp uses 1-based inclusive ranges
+    playlist_items = items and f"{items.start + 1}-{items.stop}"
+    cache_key = None
+    if _cache and url_regex.fullmatch(url):
+        cache_key = normalize_url(url)
+        data = None
+        if not refresh:
+            data = _cache.get(cache_key)
+            if playlist_items and (data is None or "entries" in data):
+                # single songs are stored without playlist items
+                data = _cache.get(f"{cache_key} {playlist_items}")
+        if data is not None:
+            return data
+    # limit by module (effectively means by site)
     # extractor *may* be lazy
     module = getmodule(getattr(ie, "real_class", ie))
-    try:
-        lock = _site_locks[module]
-    except KeyError:
-        lock = _site_locks[module] = threading.Lock()
-    with lock:
+    with _site_semaphore(module.__name__):
+        _extractor.params["playlist_items"] = playlist_items
         try:
-            return _extractor.extract_info(url, False, ie.ie_key())
+            data = _extractor.extract_info(url, False, ie.ie_key())
         except DownloadError:
             return None
+        finally:
+            _extractor.params["playlist_items"] = None
+    if data and cache_key:
+        if playlist_items and "entries" in data:
+            cache_key += " " + playlist_items
+        _cache.set(cache_key, data, _cache_expiry(data))
+    return data
+
+
+def _cache_expiry(data: dict) -> float:
+    expire = _parse_expire(data.get("url", ""))
+    if expire is None:
+        return time.time() + config.EXTRACTION_CACHE_TTL
+    # the stream must not expire before the song ends
+    return expire - (data.get("duration") or 0) - 60
 
 
 async def search_youtube(title: str, count: int = 1) -> Optional[List[dict]]:
-    return await _run_sync(_search_youtube, title, count)
+    results = search_cache.get(title, count)
+    if results is not None:
+        return results
+    results = await _run_sync(_search_youtube, title, count)
+    if results:
+        search_cache.set(title, count, results)
+    return results
 
 
 def _search_youtube(title: str, count: int = 1) -> Optional[List[dict]]:
@@ -121,11 +282,131 @@ def _search_youtube(title: str, count: int = 1) -> Optional[List[dict]]:
     return r["entries"]
 
 
-async def load_song(track: str) -> Union[Optional[Song], List[Song]]:
-    return await _run_sync(_load_song, track)
+async def load_song(
+    track: str, items: Optional[slice] = None, refresh: bool = False
+) -> Union[Optional[Song], List[Song]]:
+    """Loads song or playlist
+    If items is given, loads only that part of playlist
+    If refresh is True, cached info is ignored"""
+    if not url_regex.fullmatch(track):
+        # search here to make use of the cache
+        data = await search_youtube(track)
+        if not data:
+            # None or empty list
+            return data
+        # search results lack details, such as thumbnail
+        return await load_song(data[0]["url"], refresh=refresh)
+
+    # concurrent requests for the same URL share one extraction
+    url = normalize_url(track)
+    key = (url, items and (items.start, items.stop), refresh)
+    if key not in _loading:
+        # single songs don't depend on playlist items,
+        # so a load of the same URL with other items may be used
+        other = next(
+            (
+                future
+                for (other_url, _, other_refresh), future in _loading.items()
+                if other_url == url and other_refresh == refresh
+            ),
+            None,
+        )
+        if other is not None:
+            try:
+                loaded = await asyncio.shield(other)
+            except SongError:
+                loaded = []
+            if not isinstance(loaded, list):
+                return _copy_loaded(loaded)
+    future = _loading.get(key)
+    if future is None:
+        future = _loading[key] = asyncio.ensure_future(
+            _run_sync(_load_song, track, items, refresh)
+        )
+        future.add_done_callback(lambda _: _loading.pop(key, None))
+    # don't cancel the extraction if one of the callers is cancelled
+    return _copy_loaded(await asyncio.shield(future))
+
+
+def _copy_loaded(
+    loaded: Union[Optional[Song], List[Song]],
+) -> Union[Optional[Song], List[Song]]:
+    "Every caller of load_song gets its own copy"
+    if isinstance(loaded, list):
+        return [song.copy() for song in loaded]
+    if loaded is not None:
+        return loaded.copy()
+    return None
+
+
+async def load_song_batches(
+    track: str,
+) -> AsyncIterator[Union[Optional[Song], List[Song]]]:
+    """Same as load_song, but yields playlists in parts
+    Each part is bigger than the previous to keep the number of requests low
+    """
+    start, stop = 0, PLAYLIST_BATCH_SIZE
+    while True:
+        loaded = await load_song(track, slice(start, stop))
+        yield loaded
+        if not isinstance(loaded, list) or len(loaded) < stop - start:
+            return
+        start, stop = stop, stop * 10
+
+
+async def resolve_spotify(
+    songs: Iterable[Song], bot: MusicBot, queue: Container[Song]
+) -> None:
+    """Finds YouTube videos for Spotify songs using known metadata
+    Avoids fetching the page of each song
+    Songs that are no longer in the queue are skipped"""
+    spotify_ids = {
+        song: get_spotify_track_id(song.webpage_url)
+        for song in songs
+        if song.host == SiteTypes.SPOTIFY and song.title
+    }
+    if not spotify_ids:
+        # not a Spotify playlist
+        return
+    # preload will use saved matches, no need to search
+    matched = await SpotifyMatch.get_many(
+        bot, filter(None, spotify_ids.values())
+    )
+    await asyncio.gather(
+        *(
+            _resolve_spotify_song(song, queue)
+            for song, spotify_id in spotify_ids.items()
+            if spotify_id not in matched
+        )
+    )
 
 
-def _load_song(track: str) -> Union[Optional[Song], List[Song]]:
+async def _resolve_spotify_song(song: Song, queue: Container[Song]) -> None:
+    async with _spotify_semaphore:
+        # skip songs that were loaded or removed while waiting
+        if (
+            song.data is None
+            or song.data.get("url") != song.webpage_url
+            or song not in queue
+        ):
+            return
+        query = song.title
+        if song.uploader:
+            query += " " + song.uploader
+        try:
+            results = await search_youtube(query)
+        except Exception:
+            print(f"Failed to resolve {song.webpage_url}:", file=sys.stderr)
+            print_exc(file=sys.stderr)
+            return
+    if results and song.data.get("url") == song.webpage_url:
+        # preload will extract the video instead of Spotify page
+        song.data = results[0]
+
+
+def _load_song(
+    track: str, items: Optional[slice] = None, refresh: bool = False
+) -> Union[Optional[Song], List[Song]]:
     host = identify_url(track)
 
     if host == SiteTypes.NOT_URL:
@@ -142,20 +423,23 @@ def _load_song(track: str) -> Union[Optional[Song], List[Song]]:
 
     elif host == SiteTypes.SPOTIFY:
         try:
-            data = _loop.run_until_complete(fetch_spotify(track))
+            data = _loop.run_until_complete(fetch_spotify(track, items))
         except ClientResponseError as e:
             raise SongError(config.SONGINFO_ERROR) from e
         if isinstance(data, list):
-            data = [{"url": url, "_type": "url"} for url in data]
+            data = [{**entry, "_type": "url"} for entry in data]
 
     elif host == SiteTypes.CUSTOM:
-        data = _extract_info(track, GENERIC_IE)
+        data = _extract_info(track, GENERIC_IE, items, refresh)
 
     else:  # host is info extractor
-        data = _extract_info(track, host)
+        data = _extract_info(track, host, items, refresh)
         host = SiteTypes.YT_DLP
 
     if not data:
+        if items and items.start and isinstance(data, list):
+            # the previous part ended at the end of the playlist
+            return []
         raise SongError(config.SONGINFO_ERROR)
 
     if isinstance(data, dict):
@@ -164,7 +448,7 @@ def _load_song(track: str) -> Union[Optional[Song], List[Song]]:
             data = data["entries"]
         elif data.get("_type") == "url":
             # the URL wasn't extracted, do it now
-            return _load_song(data["url"])
+            return _load_song(data["url"], items, refresh)
 
     if isinstance(data, list):
         results = []
@@ -193,26 +477,146 @@ def _parse_expire(url: str) -> Optional[int]:
         return None
 
 
-async def preload(song: Song, bot: MusicBot) -> bool:
+def get_expire(song: Song) -> Optional[int]:
+    "Returns the timestamp when direct URL of the song expires"
+    if song.data is None or song.data.get("_type") == "url":
+        return None
+    expire = _parse_expire(song.data["url"])
+    if expire == _parse_expire(song.webpage_url):
+        # it's the webpage that has expire parameter
+        return None
+    return expire
+
+
+def is_preloaded(song: Song, margin: float = 0) -> bool:
+    """Checks whether the song has direct URL
+    that is valid for at least margin seconds"""
     if song.webpage_url is None:
         return True
 
     if song.data is not None and song.data.get("_type") != "url":
-        expire = _parse_expire(song.data["url"])
-        if expire is None or expire == _parse_expire(song.webpage_url):
+        expire = get_expire(song)
+        if expire is None:
             return True
-        if datetime.now(timezone.utc) < datetime.fromtimestamp(
-            expire, timezone.utc
-        ):
+        if datetime.now(timezone.utc) + timedelta(
+            seconds=margin
+        ) < datetime.fromtimestamp(expire, timezone.utc):
             return True
 
+    return False
+
+
+class RefreshBudget:
+    """Limits the rate of background refreshes
+    and lets them run only when a loader process is free"""
+
+    def __init__(self, per_minute: int):
+        self.per_minute = per_minute
+        self._tokens = float(per_minute)
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(
+                self.per_minute,
+                self._tokens + (now - self._updated) * self.per_minute / 60,
+            )
+            self._updated = now
+            if self._tokens >= 1 and stats.pending < config.LOADER_WORKERS:
+                self._tokens -= 1
+                return
+            await asyncio.sleep(1)
+
+
+refresh_budget = RefreshBudget(config.STREAM_REFRESHES_PER_MINUTE)
+
+
+async def preload(song: Song, bot: MusicBot, *, refresh: bool = False) -> bool:
+    """Loads direct URL of the song if needed
+    and prepares FFmpeg arguments for it
+    With refresh=True, also reloads URLs that expire
+    in less than STREAM_REFRESH_MARGIN seconds"""
+    if not is_preloaded(
+        song, config.STREAM_REFRESH_MARGIN if refresh else 0
+    ) and not await _load_data(song, bot, refresh):
+        return False
+
+    if song.ffmpeg_args is None and song.data and "ext" in song.data:
+        try:
+            song.ffmpeg_args = get_ffmpeg_args(song)
+        except Exception:
+            print("Failed to prepare FFmpeg arguments:", file=sys.stderr)
+            print_exc(file=sys.stderr)
+    if song.loudness_gain is None and song.ffmpeg_args is not None:
+        _check_loudness(song)
+    return True
+
+
+def _check_loudness(song: Song) -> None:
+    """Sets loudness gain of the song if it was measured before,
+    otherwise starts measuring it in background if it's in audio cache"""
+    if not config.LOUDNESS_ANALYSIS_CONCURRENCY or _cache is None:
+        return
+    key = section_key(song)
+    measured = _cache.get_loudness(key)
+    if measured:
+        song.loudness_gain = loudness_gain(*measured)
+    elif key not in _analyzing and audio_cache and audio_cache.peek(key):
+        task = _analyzing[key] = asyncio.create_task(
+            _analyze_loudness(song, key)
+        )
+        task.add_done_callback(lambda _: _analyzing.pop(key, None))
+
+
+async def _analyze_loudness(song: Song, key: str) -> None:
+    """Measures loudness of the song stored in audio cache,
+    faster than realtime
+    Songs aren't downloaded again just to measure them"""
+    async with _analysis_semaphore:
+        # the file may be evicted while waiting
+        path = audio_cache.peek(key)
+        if not path:
+            return
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg",
+            "-hide_banner",
+            "-nostats",
+            "-i",
+            path,
+            *"-vn -af loudnorm=print_format=json -f null -".split(),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        _, stderr = await process.communicate()
+    if process.returncode != 0:
+        print(f"Failed to measure loudness of {key}", file=sys.stderr)
+        return
+    output = stderr.decode(errors="replace")
+    try:
+        # the filter prints JSON at the end
+        loudnorm = json.loads(output[output.rindex("{") :])
+        integrated = float(loudnorm["input_i"])
+        true_peak = float(loudnorm["input_tp"])
+    except (ValueError, KeyError):
+        print(f"Unexpected loudnorm output for {key}", file=sys.stderr)
+        return
+    if not math.isfinite(integrated) or not math.isfinite(true_peak):
+        # silence
+        return
+    _cache.set_loudness(key, integrated, true_peak)
+    song.loudness_gain = loudness_gain(integrated, true_peak)
+
+
+async def _load_data(song: Song, bot: MusicBot, refresh: bool) -> bool:
     future = _preloading.get(song)
     if future:
         return await future
     _preloading[song] = asyncio.Future()
 
     try:
-        preloaded = await load_song(song.webpage_url)
+        preloaded = await _load_for_preload(song, bot, refresh)
     except SongError:
         success = False
     else:
@@ -235,11 +639,60 @@ async def preload(song: Song, bot: MusicBot) -> bool:
     return success
 
 
-async def get_ffmpeg_args(song: Song) -> OriginalArgs:
-    return await _run_sync(_get_ffmpeg_args, song)
+async def _load_for_preload(
+    song: Song, bot: MusicBot, refresh: bool
+) -> Union[Optional[Song], List[Song]]:
+    url = song.webpage_url
+    if song.data is not None and song.data.get("_type") == "url":
+        # may point to another site, e.g. YouTube for Spotify songs
+        url = song.data["url"]
+
+    spotify_id = get_spotify_track_id(song.webpage_url)
+    if spotify_id:
+        youtube_id = (await SpotifyMatch.get_many(bot, [spotify_id])).get(
+            spotify_id
+        )
+        if youtube_id:
+            try:
+                loaded = await load_song(
+                    YOUTUBE_VIDEO_URL + youtube_id, refresh=refresh
+                )
+            except SongError:
+                loaded = None
+            if loaded is not None:
+                return loaded
+            # the video is unavailable now, find another one
+            await SpotifyMatch.remove(bot, spotify_id)
+
+    loaded = await load_song(url, refresh=refresh)
+    if (
+        spotify_id
+        and isinstance(loaded, Song)
+        and loaded.data
+        and loaded.data.get("extractor_key") == "Youtube"
+    ):
+        await SpotifyMatch.save(bot, spotify_id, loaded.data["id"])
+    return loaded
+
+
+def get_ffmpeg_args(song: Song, seek: float = 0) -> InputArgs:
+    "Builds FFmpeg input arguments for the preloaded song"
+    return build_input_args(
+        song.data, _extractor.cookiejar, config.PROXY_URL, seek
+    )
+
+
+def _run_timed(submitted_at: float, f, *args):
+    return time.time() - submitted_at, f(*args)
 
 
 async def _run_sync(f, *args):
-    return await asyncio.get_running_loop().run_in_executor(
-        _executor, f, *args
-    )
+    stats.submitted += 1
+    try:
+        wait, result = await asyncio.get_running_loop().run_in_executor(
+            _executor, _run_timed, time.time(), f, *args
+        )
+    finally:
+        stats.completed += 1
+    stats.add_wait(wait)
+    return result
@@ -39,6 +39,9 @@ class Playlist:
     def __getitem__(self, key: int) -> Song:
         return self.playque[key]
 
+    def __contains__(self, track: Song) -> bool:
+        return track in self.playque
+
     def add_name(self, trackname: str):
         if self.trackname_history and self.trackname_history[-1] == trackname:
             return
@@ -76,6 +79,19 @@ class Playlist:
 
         return self.playque[0]
 
+    def peek_next(self) -> Optional[Song]:
+        "Returns the song that next() would return, without changing queue"
+        if len(self.playque) == 0:
+            return None
+
+        if self.loop == LoopMode.OFF:
+            return self.playque[1] if len(self.playque) > 1 else None
+
+        if self.loop == LoopMode.ALL:
+            return self.playque[1 % len(self.playque)]
+
+        return self.playque[0]
+
     def prev(self) -> Optional[Song]:
         if self.loop != LoopMode.ALL:
             if len(self.playhistory) != 0:
@@ -0,0 +1,128 @@
+import time
+import asyncio
+from itertools import islice
+from typing import TYPE_CHECKING, Dict, List, Optional, Set
+
+from config import config
+from musicbot import loader
+from musicbot.song import Song
+from musicbot.playlist import Playlist
+
+# avoiding circular import
+if TYPE_CHECKING:
+    from musicbot.bot import MusicBot
+
+
+class QueuePreloader:
+    """Preloads the first MAX_SONG_PRELOAD songs of the queue
+    The next song is preloaded immediately,
+    others wait for one of PRELOAD_CONCURRENCY slots in queue order
+    Preloaded songs are refreshed before their stream URLs expire"""
+
+    def __init__(self, bot: "MusicBot", playlist: Playlist):
+        self.bot = bot
+        self.playlist = playlist
+        self._semaphore = asyncio.Semaphore(config.PRELOAD_CONCURRENCY)
+        self._tasks: Dict[Song, asyncio.Task] = {}
+        # tasks that didn't start preloading yet
+        self._queued: Set[asyncio.Task] = set()
+        self._refresh_timer: Optional[asyncio.TimerHandle] = None
+
+    def schedule(self):
+        """Brings preloading in line with the current queue
+        Should be called after every change of the queue"""
+        window = list(
+            islice(self.playlist.playque, 1, config.MAX_SONG_PRELOAD)
+        )
+        wanted = [song for song in window if not loader.is_preloaded(song)]
+        expiring = [
+            song
+            for song in window
+            if song not in wanted
+            and not loader.is_preloaded(song, config.STREAM_REFRESH_MARGIN)
+        ]
+
+        for song, task in list(self._tasks.items()):
+            # running preloads are left to finish, they'll be useful later
+            if (
+                task in self._queued
+                and song not in wanted
+                and song not in expiring
+            ):
+                del self._tasks[song]
+                task.cancel()
+
+        if wanted and self._tasks.get(wanted[0]) in self._queued:
+            # the next song must not wait for others
+            self._tasks.pop(wanted[0]).cancel()
+
+        for i, song in enumerate(wanted):
+            if song not in self._tasks:
+                self._tasks[song] = asyncio.create_task(
+                    self._preload(song, priority=i == 0)
+                )
+
+        for song in expiring:
+            if song not in self._tasks:
+                self._tasks[song] = asyncio.create_task(self._refresh(song))
+
+        self._schedule_refresh(window)
+
+    def _schedule_refresh(self, window: List[Song]):
+        "Wakes up when the first song in the window needs refreshing"
+        if self._refresh_timer:
+            self._refresh_timer.cancel()
+            self._refresh_timer = None
+        if not config.STREAM_REFRESH_MARGIN:
+            return
+        now = time.time()
+        refresh_times = [
+            expire - config.STREAM_REFRESH_MARGIN
+            for expire in map(loader.get_expire, window)
+            if expire and expire - config.STREAM_REFRESH_MARGIN > now
+        ]
+        if refresh_times:
+            self._refresh_timer = asyncio.get_running_loop().call_later(
+                min(refresh_times) - now, self.schedule
+            )
+
+    async def _refresh(self, song: Song):
+        task = asyncio.current_task()
+        self._queued.add(task)
+        try:
+            await loader.refresh_budget.acquire()
+            self._queued.discard(task)
+            # the old URL is still valid, so failure isn't critical
+            await asyncio.shield(loader.preload(song, self.bot, refresh=True))
+        finally:
+            self._queued.discard(task)
+            if self._tasks.get(song) is task:
+                del self._tasks[song]
+
+    async def _preload(self, song: Song, priority: bool):
+        task = asyncio.current_task()
+        try:
+            if priority:
+                success = await asyncio.shield(loader.preload(song, self.bot))
+            else:
+                self._queued.add(task)
+                try:
+                    async with self._semaphore:
+                        self._queued.discard(task)
+                        # cancelling preload may leave it in broken state
+                        success = await asyncio.shield(
+                            loader.preload(song, self.bot)
+                        )
+                finally:
+                    self._queued.discard(task)
+        finally:
+            if self._tasks.get(song) is task:
+                del self._tasks[song]
+
+        if not success:
+            try:
+                self.playlist.playque.remove(song)
+            except ValueError:
+                # already removed
+                pass
+            self.schedule()
@@ -0,0 +1,202 @@
+import sys
+import time
+import asyncio
+import threading
+from traceback import print_exc
+from typing import Dict, List, Optional, Set, Tuple
+
+from discord import AudioSource, SpeakingState, VoiceClient
+from discord.opus import Encoder as OpusEncoder
+
+FRAME_DELAY = OpusEncoder.FRAME_LENGTH / 1000
+# a late thread skips ticks instead of sending a burst of packets
+MAX_LATENESS = 0.2
+
+
+def _speak(client: VoiceClient, state: SpeakingState) -> None:
+    # same as discord.py player does
+    try:
+        asyncio.run_coroutine_threadsafe(
+            client.ws.speak(state), client.client.loop
+        )
+    except Exception:
+        print_exc(file=sys.stderr)
+
+
+class _TickThread:
+    "Reads all its sources every 20 ms and sends the packets"
+
+    def __init__(self):
+        # source -> (voice client, encoder if the source gave PCM)
+        self._players: Dict[
+            AudioSource, Tuple[VoiceClient, Optional[OpusEncoder]]
+        ] = {}
+        # sources that aren't read until resumed
+        self._paused: Set[AudioSource] = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return len(self._players)
+
+    def __contains__(self, source: AudioSource) -> bool:
+        return source in self._players
+
+    def add(self, source: AudioSource, client: VoiceClient) -> None:
+        with self._lock:
+            self._players[source] = (client, None)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        _speak(client, SpeakingState.voice)
+        self._wakeup.set()
+
+    def remove(self, source: AudioSource) -> bool:
+        player = self._pop(source)
+        if player is None:
+            return False
+        self._close(source, player[0])
+        return True
+
+    def _remove_later(self, source: AudioSource) -> None:
+        "Stops reading the source and cleans it up in another thread"
+        player = self._pop(source)
+        if player is not None:
+            # cleanup may wait for FFmpeg, other sources shouldn't
+            threading.Thread(
+                target=self._close, args=(source, player[0]), daemon=True
+            ).start()
+
+    def _pop(
+        self, source: AudioSource
+    ) -> Optional[Tuple[VoiceClient, Optional[OpusEncoder]]]:
+        with self._lock:
+            player = self._players.pop(source, None)
+            self._paused.discard(source)
+        return player
+
+    @staticmethod
+    def _close(source: AudioSource, client: VoiceClient) -> None:
+        _speak(client, SpeakingState.none)
+        source.cleanup()
+
+    def pause(self, source: AudioSource) -> bool:
+        with self._lock:
+            player = self._players.get(source)
+            if player is None:
+                return False
+            self._paused.add(source)
+        _speak(player[0], SpeakingState.none)
+        return True
+
+    def resume(self, source: AudioSource) -> bool:
+        with self._lock:
+            player = self._players.get(source)
+            if player is None:
+                return False
+            self._paused.discard(source)
+        _speak(player[0], SpeakingState.voice)
+        self._wakeup.set()
+        return True
+
+    def _run(self):
+        tick = time.perf_counter()
+        while True:
+            with self._lock:
+                players = [
+                    player
+                    for player in self._players.items()
+                    if player[0] not in self._paused
+                ]
+                if not players:
+                    self._wakeup.clear()
+            if not players:
+                self._wakeup.wait()
+                tick = time.perf_counter()
+                continue
+
+            packets = self._read(players)
+            # encode in one pass, so that reading isn't delayed by it
+            for source, client, encoder, data in packets:
+                try:
+                    if not source.is_opus():
+                        if encoder is None:
+                            encoder = self._add_encoder(source, client)
+                        data = encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+                    client.send_audio_packet(data, encode=False)
+                except Exception:
+                    # don't stop other clients
+                    print_exc(file=sys.stderr)
+
+            tick += FRAME_DELAY
+            delay = tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -MAX_LATENESS:
+                tick = time.perf_counter()
+
+    def _read(
+        self,
+        players: List[
+            Tuple[AudioSource, Tuple[VoiceClient, Optional[OpusEncoder]]]
+        ],
+    ) -> List[Tuple[AudioSource, VoiceClient, Optional[OpusEncoder], bytes]]:
+        packets = []
+        for source, (client, encoder) in players:
+            if not client.is_connected():
+                # wait for reconnection like discord.py player does
+                continue
+            try:
+                data = source.read()
+            except Exception:
+                print_exc(file=sys.stderr)
+                self._remove_later(source)
+                continue
+            if not data:
+                self._remove_later(source)
+                continue
+            packets.append((source, client, encoder, data))
+        return packets
+
+    def _add_encoder(
+        self, source: AudioSource, client: VoiceClient
+    ) -> OpusEncoder:
+        encoder = OpusEncoder()
+        with self._lock:
+            if source in self._players:
+                self._players[source] = (client, encoder)
+        return encoder
+
+
+class AudioScheduler:
+    """Plays sources for all voice clients from a fixed number of threads
+    instead of starting a discord.py player thread for each client"""
+
+    def __init__(self, thread_count: int):
+        self._threads = [_TickThread() for _ in range(thread_count)]
+
+    def play(self, source: AudioSource, client: VoiceClient) -> None:
+        if self.is_playing(source):
+            return
+        min(self._threads, key=len).add(source, client)
+
+    def stop(self, source: AudioSource) -> None:
+        "Stops playing the source and cleans it up"
+        for thread in self._threads:
+            if thread.remove(source):
+                return
+
+    def pause(self, source: AudioSource) -> None:
+        "Stops reading the source without cleaning it up"
+        for thread in self._threads:
+            if thread.pause(source):
+                return
+
+    def resume(self, source: AudioSource) -> None:
+        for thread in self._threads:
+            if thread.resume(source):
+                return
+
+    def is_playing(self, source: AudioSource) -> bool:
+        return any(source in thread for thread in self._threads)
@@ -1,8 +1,9 @@
 import json
 import os
 import re
+import time
 from inspect import isawaitable
-from typing import TYPE_CHECKING, Dict, List, Optional
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional
 
 import discord
 from discord import (
@@ -14,7 +15,7 @@ from discord import (
     utils,
 )
 import sqlalchemy
-from sqlalchemy import String, select
+from sqlalchemy import String, select, delete
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 from alembic.migration import MigrationContext
 from alembic.autogenerate import produce_migrations, render_python_code
@@ -22,7 +23,7 @@ from alembic.operations import Operations
 from typing_extensions import Annotated
 
 from config import config
-from musicbot.utils import StrEnum, get_emoji
+from musicbot.utils import StrEnum, chunks, get_emoji
 
 # avoiding circular import
 if TYPE_CHECKING:
@@ -310,6 +311,55 @@ class SavedPlaylist(Base):
     songs_json: Mapped[str]
 
 
+class SpotifyMatch(Base):
+    __tablename__ = "spotify_matches"
+
+    spotify_id: Mapped[str] = mapped_column(String(32), primary_key=True)
+    youtube_id: Mapped[str] = mapped_column(String(32))
+    updated_at: Mapped[int]
+
+    @classmethod
+    async def get_many(
+        cls, bot: "MusicBot", spotify_ids: Iterable[str]
+    ) -> Dict[str, str]:
+        """Returns dict with Spotify ids as keys and YouTube ids as values
+        Matches older than SPOTIFY_MATCH_MAX_AGE are ignored"""
+        result = {}
+        async with bot.DbSession() as session:
+            # avoid hitting the limit of query parameters
+            for part in chunks(list(set(spotify_ids)), 500):
+                query = select(cls.spotify_id, cls.youtube_id).where(
+                    cls.spotify_id.in_(part)
+                )
+                if config.SPOTIFY_MATCH_MAX_AGE:
+                    query = query.where(
+                        cls.updated_at
+                        >= time.time() - config.SPOTIFY_MATCH_MAX_AGE * 86400
+                    )
+                result.update((await session.execute(query)).all())
+        return result
+
+    @classmethod
+    async def save(cls, bot: "MusicBot", spotify_id: str, youtube_id: str):
+        async with bot.DbSession() as session:
+            await session.merge(
+                cls(
+                    spotify_id=spotify_id,
+                    youtube_id=youtube_id,
+                    updated_at=int(time.time()),
+                )
+            )
+            await session.commit()
+
+    @classmethod
+    async def remove(cls, bot: "MusicBot", spotify_id: str):
+        async with bot.DbSession() as session:
+            await session.execute(
+                delete(cls).where(cls.spotify_id == spotify_id)
+            )
+            await session.commit()
+
+
 def run_migrations(connection):
     """Automatically creates or deletes tables and columns
     Reflects code changes"""
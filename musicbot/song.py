@@ -1,4 +1,5 @@
 from __future__ import annotations
+import copy
 import datetime
 from urllib.parse import urlparse, parse_qs
 from typing import TYPE_CHECKING, Optional, Union
@@ -10,6 +11,7 @@ from musicbot.linkutils import SiteTypes
 from musicbot.timeparse import timeparse
 
 if TYPE_CHECKING:
+    from musicbot.ffmpeg import InputArgs
     from musicbot.settings import SavedPlaylist
 
 
@@ -33,6 +35,10 @@ class Song:
         self.duration = duration
         self.thumbnail = thumbnail
         self.playlist = playlist
+        # prepared during preload, depends on data
+        self.ffmpeg_args: Optional[InputArgs] = None
+        # known after loudness analysis, in dB
+        self.loudness_gain: Optional[float] = None
 
         start = end = None
         params = parse_qs(urlparse(webpage_url).query)
@@ -60,13 +66,7 @@ class Song:
             inline=False,
         )
 
-        duration = self.duration
-        if self.data and (
-            self.data.get("section_start") or self.data.get("section_end")
-        ):
-            end = self.data.get("section_end", duration)
-            if end:
-                duration = end - self.data.get("section_start", 0)
+        duration = self.played_duration
 
         embed.add_field(
             name=config.SONGINFO_DURATION,
@@ -80,11 +80,30 @@ class Song:
 
         return embed
 
+    @property
+    def played_duration(self) -> Optional[int]:
+        "Duration of the part of the song that is played"
+        duration = self.duration
+        if self.data and (
+            self.data.get("section_start") or self.data.get("section_end")
+        ):
+            end = self.data.get("section_end", duration)
+            if end:
+                duration = end - self.data.get("section_start", 0)
+        return duration
+
+    def copy(self) -> Song:
+        song = copy.copy(self)
+        if self.data is not None:
+            song.data = self.data.copy()
+        return song
+
     def update(self, data: Union[dict, "Song"]):
         if isinstance(data, Song):
             for k, v in data.__dict__.items():
                 if v:
                     setattr(self, k, v)
+            self.ffmpeg_args = data.ffmpeg_args
         else:
             start_time = data.get("start_time", self._start)
             if start_time:
@@ -94,6 +113,7 @@ class Song:
                 data["section_end"] = end_time
 
             self.data = data
+            self.ffmpeg_args = None
 
             self.title = data.get("title") or self.title
             self.uploader = data.get("uploader") or self.uploader
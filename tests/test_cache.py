@@ -0,0 +1,32 @@
+from musicbot.cache import AudioCache
+
+
+def add_file(cache: AudioCache, key: str) -> None:
+    path = cache.new_file()
+    with open(path, "wb") as f:
+        f.write(b"\0" * 100)
+    cache.add(key, path)
+
+
+def test_peek_doesnt_touch(tmp_path):
+    cache = AudioCache(str(tmp_path), 250)
+    add_file(cache, "first")
+    add_file(cache, "second")
+    assert cache.peek("first")
+    assert cache.peek("missing") is None
+    assert cache.hits == cache.misses == 0
+    # the first file is still the least recently used one
+    add_file(cache, "third")
+    assert cache.peek("first") is None
+    assert cache.peek("second")
+
+
+def test_get_touches(tmp_path):
+    cache = AudioCache(str(tmp_path), 250)
+    add_file(cache, "first")
+    add_file(cache, "second")
+    assert cache.get("first")
+    add_file(cache, "third")
+    assert cache.get("first")
+    assert cache.get("second") is None
+    assert (cache.hits, cache.misses) == (2, 1)
@@ -0,0 +1,58 @@
+import subprocess
+
+import pytest
+from discord.opus import Encoder as OpusEncoder
+
+from config import config
+from musicbot.ffmpeg import OPUS_HEADERS, RewindBuffer, _ReadAheadOpusAudio
+
+OPUS_FILE = "assets/hello.opus"
+
+
+class FileOpusAudio(_ReadAheadOpusAudio):
+    "Reads Ogg Opus file with cat instead of FFmpeg"
+
+    def __init__(self, path: str):
+        self.path = path
+        super().__init__(path, codec="opus")
+
+    def _spawn_process(self, args, **subprocess_kwargs):
+        return subprocess.Popen(["cat", self.path], stdout=subprocess.PIPE)
+
+
+@pytest.mark.parametrize("read_ahead", [0, 1, 50])
+def test_opus_headers_skipped(monkeypatch, read_ahead):
+    monkeypatch.setattr(config, "READ_AHEAD_FRAMES", read_ahead)
+    source = FileOpusAudio(OPUS_FILE)
+    try:
+        frames = []
+        while frame := source.read():
+            frames.append(bytes(frame))
+    finally:
+        source.cleanup()
+    assert frames
+    assert not any(frame.startswith(OPUS_HEADERS) for frame in frames)
+
+
+def test_rewind_buffer_grows():
+    history = RewindBuffer(10, 2)
+    history.append(b"a" * 100, True)
+    assert len(history._data) < 10 * RewindBuffer.FRAME_BYTES
+    packets = [bytes([i]) * 300 for i in range(20)]
+    for packet in packets:
+        history.append(packet, True)
+    assert len(history._data) == 10 * RewindBuffer.FRAME_BYTES
+    assert history.get(20) == packets[-len(history) :]
+
+
+def test_rewind_buffer_mode_switch():
+    history = RewindBuffer(10, 2)
+    for i in range(5):
+        history.append(bytes([i]) * 300, True)
+    allocated = history._data
+    frames = [bytes([i]) * OpusEncoder.FRAME_SIZE for i in range(3)]
+    for frame in frames:
+        history.append(frame, False)
+    assert history._data is allocated
+    assert not history.opus
+    assert history.get(10) == frames[-2:]
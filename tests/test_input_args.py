@@ -0,0 +1,179 @@
+from http.cookiejar import Cookie
+
+from yt_dlp.cookies import YoutubeDLCookieJar
+
+from musicbot.ffmpeg import RECONNECT_ARGS, build_input_args
+
+HEADERS = {"User-Agent": "Mozilla/5.0", "Accept": "*/*"}
+HEADERS_ARG = "User-Agent: Mozilla/5.0\r\nAccept: */*\r\n"
+
+HLS_INFO = {
+    "id": "hls",
+    "url": "https://example.com/audio/index.m3u8",
+    "protocol": "m3u8_native",
+    "ext": "mp4",
+    "acodec": "mp4a.40.2",
+    "http_headers": HEADERS,
+}
+DASH_LIVE_INFO = {
+    "id": "dash",
+    "is_live": True,
+    "requested_formats": [
+        {
+            "format_id": "video",
+            "url": "https://example.com/video.mpd",
+            "protocol": "http_dash_segments",
+            "acodec": "none",
+            "vcodec": "avc1",
+        },
+        {
+            "format_id": "audio",
+            "url": "https://example.com/audio.mpd",
+            "protocol": "http_dash_segments",
+            "acodec": "opus",
+            "vcodec": "none",
+            "http_headers": HEADERS,
+        },
+    ],
+}
+RTMP_INFO = {
+    "id": "rtmp",
+    "url": "rtmp://example.com/live",
+    "protocol": "rtmp",
+    "ext": "flv",
+    "player_url": "https://example.com/player.swf",
+    "page_url": "https://example.com/watch",
+    "app": "live",
+    "play_path": "mp3:stream",
+    "tc_url": "rtmp://example.com/live",
+    "flash_version": "LNX 11,2,202,481",
+    "rtmp_live": True,
+    "rtmp_conn": ["B:1", "S:token"],
+}
+# headers are set only for the whole video
+HEADER_ONLY_INFO = {
+    "id": "headers",
+    "is_live": False,
+    "http_headers": HEADERS,
+    "requested_formats": [
+        {
+            "format_id": "audio",
+            "url": "https://example.com/audio.webm",
+            "protocol": "https",
+            "acodec": "opus",
+        }
+    ],
+}
+
+
+def option(args, name):
+    return args[args.index(name) + 1]
+
+
+def test_hls():
+    args, env = build_input_args(HLS_INFO)
+    assert args == [
+        *RECONNECT_ARGS.split(),
+        "-headers",
+        HEADERS_ARG,
+        "-i",
+        HLS_INFO["url"],
+    ]
+    assert env is None
+
+
+def test_dash_live():
+    args, _ = build_input_args(DASH_LIVE_INFO)
+    assert "-re" in args
+    assert option(args, "-headers") == HEADERS_ARG
+    assert args[-2:] == ["-i", "https://example.com/audio.mpd"]
+
+
+def test_dash_not_live():
+    args, _ = build_input_args({**DASH_LIVE_INFO, "is_live": False})
+    assert "-re" not in args
+
+
+def test_rtmp():
+    args, _ = build_input_args(RTMP_INFO)
+    assert option(args, "-rtmp_swfverify") == RTMP_INFO["player_url"]
+    assert option(args, "-rtmp_pageurl") == RTMP_INFO["page_url"]
+    assert option(args, "-rtmp_app") == "live"
+    assert option(args, "-rtmp_playpath") == "mp3:stream"
+    assert option(args, "-rtmp_tcurl") == RTMP_INFO["tc_url"]
+    assert option(args, "-rtmp_flashver") == RTMP_INFO["flash_version"]
+    assert option(args, "-rtmp_live") == "live"
+    assert [
+        args[i + 1] for i, arg in enumerate(args) if arg == "-rtmp_conn"
+    ] == ["B:1", "S:token"]
+    # reconnect options are for HTTP only
+    assert "-reconnect" not in args
+    assert args[-2:] == ["-i", RTMP_INFO["url"]]
+
+
+def test_rtmp_single_conn():
+    args, _ = build_input_args({**RTMP_INFO, "rtmp_conn": "S:token"})
+    assert option(args, "-rtmp_conn") == "S:token"
+
+
+def test_headers_fallback():
+    args, _ = build_input_args(HEADER_ONLY_INFO)
+    assert option(args, "-headers") == HEADERS_ARG
+
+
+def test_format_headers_preferred():
+    fmt = {**HEADER_ONLY_INFO["requested_formats"][0]}
+    fmt["http_headers"] = {"Referer": "https://example.com/"}
+    args, _ = build_input_args(
+        {**HEADER_ONLY_INFO, "requested_formats": [fmt]}
+    )
+    assert option(args, "-headers") == "Referer: https://example.com/\r\n"
+
+
+def test_ffmpeg_args():
+    info = {
+        **HLS_INFO,
+        "downloader_options": {"ffmpeg_args": ["-http_seekable", "0"]},
+    }
+    args, _ = build_input_args(info)
+    assert args[-4:] == ["-http_seekable", "0", "-i", HLS_INFO["url"]]
+
+
+def test_section_and_seek():
+    info = {**HLS_INFO, "section_start": 10, "section_end": 70}
+    args, _ = build_input_args(info, seek=5)
+    assert option(args, "-ss") == "15"
+    assert option(args, "-t") == "55"
+
+
+def test_cookies():
+    cookiejar = YoutubeDLCookieJar()
+    cookiejar.set_cookie(
+        Cookie(
+            version=0,
+            name="token",
+            value="secret",
+            port=None,
+            port_specified=False,
+            domain="example.com",
+            domain_specified=False,
+            domain_initial_dot=False,
+            path="/",
+            path_specified=True,
+            secure=False,
+            expires=None,
+            discard=False,
+            comment=None,
+            comment_url=None,
+            rest={},
+        )
+    )
+    args, _ = build_input_args(HLS_INFO, cookiejar)
+    assert option(args, "-cookies") == (
+        "token=secret; path=/; domain=example.com;\r\n"
+    )
+
+
+def test_proxy():
+    _, env = build_input_args(HLS_INFO, proxy="127.0.0.1:8080")
+    assert env["http_proxy"] == env["HTTP_PROXY"] == "http://127.0.0.1:8080"